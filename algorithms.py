@@ -1,7 +1,33 @@
+import json
 import math
 import pprint
+import time
 
-from poker import sample_game, simulate_game, draw_randomness
+from math import comb
+
+import numpy as np
+
+from poker import (
+    sample_game,
+    draw_dealer_cards,
+    score_kept_hands,
+    simulate_game_from_ordinals,
+)
+from stats import compute_exact_sums
+
+
+# The arrays of psp's statistics, with their types, and the maps built from them when PSP stops.
+PSP_ARRAY_KEYS = {
+    "U": np.int64,
+    "V": np.int64,
+    "num_samples": np.int64,
+    "epsilons": np.float64,
+    "estimates": np.float64,
+    "variances": np.float64,
+    "active": bool,
+    "eliminated": bool,
+}
+PSP_MAP_KEYS = ["stats", "epsilon_map", "estimate_map", "variance_map", "active_set"]
 
 
 def compute_stats(U, V, m, c, delta, T, size_of_game):
@@ -25,6 +51,42 @@ def compute_stats(U, V, m, c, delta, T, size_of_game):
     return eps
 
 
+def compute_epsilons(U, V, m, c, delta, T, size_of_game):
+    """
+    Vectorized version of compute_stats: computes the epsilons of many strategy profiles at once.
+    :param U: an array with the sums of payoffs of the strategy profiles.
+    :param V: an array with the sums of squared payoffs of the strategy profiles.
+    :return: an array with the epsilons.
+    """
+    return compute_bernstein_epsilons(
+        U, V, m, c, math.log(3 * size_of_game * T / delta)
+    )
+
+
+def compute_bernstein_epsilons(U, V, m, c, log_term):
+    """
+    Computes the epsilons of many strategy profiles, given the log term of the empirical Bernstein bound, i.e., the
+    log of 3 over the failure probability of each profile's bound.
+    :param U: an array with the sums of payoffs of the strategy profiles.
+    :param V: an array with the sums of squared payoffs of the strategy profiles.
+    :return: an array with the epsilons.
+    """
+    v_hat = (V - (U.astype(np.float64) * U / m)) / (m - 1)
+
+    v_tilde = (
+        v_hat
+        + (c * c * log_term) / (m - 1)
+        + np.sqrt(
+            (c * c * log_term / (m - 1)) ** 2 + (2 * c * c * v_hat * log_term / (m - 1))
+        )
+    )
+
+    return np.minimum(
+        c * math.sqrt(log_term / (2 * m)),
+        c * log_term / (3 * m) + np.sqrt(2 * v_tilde * log_term / m),
+    )
+
+
 def compute_schedule_length(target_epsilon, c=2.0, beta=2.0):
     return max(
         1, math.floor(math.log((3.0 * c) / (14.0 * target_epsilon), beta))
@@ -32,99 +94,848 @@ def compute_schedule_length(target_epsilon, c=2.0, beta=2.0):
     # return max(1, math.floor(math.log((3.0 * c) / (4.0 * target_epsilon), beta))) #alpha 2/3
 
 
-def psp(game, target_epsilon, target_delta, c=2.0, beta=2.0, do_floor=False):
-
-    # Initialize schedule and other structures.
+def compute_schedule(target_epsilon, target_delta, c, beta, size_of_game):
+    """
+    :return: PSP's schedule, i.e., the total number of samples drawn by the end of each iteration.
+    """
     T = compute_schedule_length(target_epsilon, c, beta)
     alpha = ((7.0 * c) / (3.0 * target_epsilon)) * math.log(
-        (3.0 * T * game["size_of_game"]) / target_delta
+        (3.0 * T * size_of_game) / target_delta
     )
 
     """
-    S = len(game["strategy_profiles"].keys())
     alpha = ((2.0 * c) / (3.0 * target_epsilon)) * math.log(
         (3.0 * T * S) / target_delta
     )
     """
-    active_set = game["strategy_profiles"].keys()
-    stats = {strategy_profile: {"U": 0, "V": 0} for strategy_profile in active_set}
-    m = 0
+    return [math.ceil(alpha * (beta ** t)) for t in range(1, T + 1)]
 
-    psp_stats = {
-        "stats": stats,
-        "schedule": [math.ceil(alpha * (beta ** t)) for t in range(1, T + 1)],
-        "active_set_len": [],
-        "emp_simulation_complexity": 0,
-        "emp_sample_complexity": 0,
-        "epsilon_map": {strategy_profile: math.inf for strategy_profile in active_set},
-        "estimate_map": {strategy_profile: 0 for strategy_profile in active_set},
-        "variance_map": {strategy_profile: 0 for strategy_profile in active_set},
-    }
 
-    # Iterate as per the schedule
-    for t in range(1, T + 1):
+class UnionBound:
+    """
+    PSP's bound: the schedule has T geometric iterations, fixed in advance (see compute_schedule), and the failure
+    probability is split evenly between the T iterations and the strategy profiles by a union bound.
+    """
+
+    def __init__(
+        self, target_epsilon, target_delta, c, beta, size_of_game, num_outcomes
+    ):
+        self.c = c
+        self.schedule = compute_schedule(
+            target_epsilon, target_delta, c, beta, size_of_game
+        )
+        self.log_term = math.log(3 * size_of_game * len(self.schedule) / target_delta)
 
-        # Compute number of samples
-        m_marginal = math.ceil(alpha * (beta ** t)) - m
-        m = math.ceil(alpha * (beta ** t))
+    def compute_epsilons(self, U, V, m, t):
+        """
+        :return: the epsilons of the profiles with sums U and V over m samples, at the t-th iteration.
+        """
+        return compute_bernstein_epsilons(U, V, m, self.c, self.log_term)
+
+
+class AnytimeBound:
+    """
+    An anytime-valid bound: the failure probability of the t-th iteration is 6 target_delta / (pi^2 t^2), split
+    between the strategy profiles, and these sum to target_delta over any number of iterations. The schedule is thus
+    not limited to T iterations: it grows geometrically from the first number of samples at which a profile could be
+    pruned, and beta can be small, so that pruning is checked often, for the price of a log(t^2) term instead of
+    log(T). Its last iteration, before it would have as many samples as outcomes, evaluates every outcome instead.
+    """
+
+    def __init__(
+        self, target_epsilon, target_delta, c, beta, size_of_game, num_outcomes
+    ):
+        self.c = c
+        self.target_delta = target_delta
+        self.size_of_game = size_of_game
+        # No profile is pruned while c * log_term / (3 * m), the first term of the Bernstein bound, exceeds the target.
+        m = c * self.get_log_term(1) / (3 * target_epsilon)
+        self.schedule = []
+        while m < num_outcomes:
+            self.schedule.append(
+                max(math.ceil(m), self.schedule[-1] + 1 if self.schedule else 1)
+            )
+            m *= beta
+        # Past as many samples as outcomes, the next iteration evaluates every outcome instead.
+        self.schedule.append(
+            (self.schedule[-1] if self.schedule else 0) + num_outcomes + 1
+        )
+
+    def get_log_term(self, t):
+        return math.log(
+            3 * self.size_of_game * math.pi ** 2 * t ** 2 / (6 * self.target_delta)
+        )
+
+    def compute_epsilons(self, U, V, m, t):
+        """
+        :return: the epsilons of the profiles with sums U and V over m samples, at the t-th iteration.
+        """
+        return compute_bernstein_epsilons(U, V, m, self.c, self.get_log_term(t))
+
+
+# The bounds psp can use, by name.
+BOUNDS = {"union": UnionBound, "anytime": AnytimeBound}
+
+
+def psp(
+    game,
+    target_epsilon,
+    target_delta,
+    c=2.0,
+    beta=2.0,
+    do_floor=False,
+    seed=None,
+    callback=None,
+    deadline=None,
+    max_simulations=None,
+    psp_state=None,
+    bound="union",
+    eliminate_dominated=False,
+):
+    """
+    Runs progressive sampling with pruning (PSP) on a game, until it stops (see psp_iter).
+    :return: a dictionary with the statistics of the run.
+    """
+    for psp_stats in psp_iter(
+        game,
+        target_epsilon,
+        target_delta,
+        c,
+        beta,
+        do_floor,
+        seed,
+        callback,
+        deadline,
+        max_simulations,
+        psp_state,
+        bound,
+        eliminate_dominated,
+    ):
+        pass
+    return psp_stats
+
+
+def psp_iter(
+    game,
+    target_epsilon,
+    target_delta,
+    c=2.0,
+    beta=2.0,
+    do_floor=False,
+    seed=None,
+    callback=None,
+    deadline=None,
+    max_simulations=None,
+    psp_state=None,
+    bound="union",
+    eliminate_dominated=False,
+):
+    """
+    Runs progressive sampling with pruning (PSP) on a game, yielding its statistics after each iteration of the
+    schedule, so that a caller can use the estimates available so far, or stop early, e.g., by closing the generator.
+    Whenever it stops, with probability at least 1 - target_delta, every strategy profile's estimate is within its
+    epsilon of its expected payoff, and psp_stats["epsilon"] is the largest of these.
+    Each dictionary yielded is a snapshot of the run after an iteration, which later iterations do not modify. Its
+    estimates and epsilons are in the arrays psp_stats["estimates"] and psp_stats["epsilons"], indexed like
+    psp_stats["profiles"], and in the maps estimate_map and epsilon_map (see build_psp_maps). The last one also has the
+    reason why PSP stopped in psp_stats["stop_reason"]: "converged", "exact", "schedule_end", "deadline" or
+    "max_simulations".
+    A run can continue a previous run on the same game, e.g., to refine its estimates to a tighter target epsilon,
+    or after a deadline, from the statistics it returned, possibly saved with save_psp_state. Only the profiles whose
+    epsilon exceeds the new target are reactivated, their sums are kept, and only the marginal samples are drawn: the
+    iterations of the new schedule with no more samples than reactivated profiles already have are skipped, and
+    profiles with fewer samples than others simulate fewer of the new ones. The new epsilons are computed with the new
+    target delta and schedule, so every estimate is within its epsilon with probability at least 1 - the sum of the
+    target deltas of the runs, psp_stats["delta"].
+    :param game: a poker game.
+    :param target_epsilon: the target error of the estimates.
+    :param target_delta: the target failure probability.
+    :param c: the range of the payoffs.
+    :param beta: the geometric ratio of the schedule.
+    :param do_floor: floors card scores.
+    :param seed: the seed of the random number generator that draws dealer cards. If None, dealer cards are drawn
+    with the game's random number generator, continuing its stream, or, when continuing a run, continuing the
+    stream of the previous run. Continuing a run with the seed of the previous run would draw its samples again.
+    :param callback: a function called after each iteration of the schedule with the iteration's metrics (see
+    get_iteration_metrics), e.g., the one returned by write_psp_metrics. If None, no metrics are computed.
+    :param deadline: a time, as given by time.time(), after which no iteration is started. The iteration running at
+    the deadline is completed, so the run can end after the deadline, by up to the duration of one iteration. If None,
+    no deadline.
+    :param max_simulations: the largest simulation complexity allowed; an iteration that would exceed it is not
+    started. If None, no limit.
+    :param psp_state: the statistics of a previous run on the game, which are not modified, or None to start anew.
+    :param bound: the name of the bound that gives the schedule and the epsilons, a key of BOUNDS: "union", PSP's
+    union bound over a schedule of fixed length, or "anytime", an anytime-valid bound.
+    :param eliminate_dominated: whether to also stop sampling the profiles where a player plays a strategy that is
+    dominated given the confidence intervals of the estimates, see eliminate_dominated_strategies. The estimates of
+    these profiles may then be worse than target_epsilon, but with probability at least 1 - target_delta, every
+    Nash equilibrium of the empirical game restricted to the remaining strategies is a psp_stats["nash_epsilon"]-Nash
+    equilibrium of the game.
+    :return: a generator of dictionaries with the statistics of the run.
+    """
+    if seed is not None:
+        rng = np.random.default_rng(seed)
+    elif psp_state is not None and psp_state["rng_state"] is not None:
+        rng = np.random.default_rng()
+        rng.bit_generator.state = psp_state["rng_state"]
+    else:
+        rng = game["rng"]
+
+    # Number of distinct outcomes, that is, of distinct draws of dealer cards.
+    num_outcomes = comb(len(game["deck"]), game["num_discard_cards"])
+
+    # Initialize schedule and other structures.
+    bound = BOUNDS[bound](
+        target_epsilon, target_delta, c, beta, game["size_of_game"], num_outcomes
+    )
+    schedule = bound.schedule
+    T = len(schedule)
+    profiles = list(game["strategy_profiles"].keys())
+    # Strategy profiles with the same representative pair of discard choices have the same payoffs, up to a
+    # permutation of suits, so only representatives are simulated.
+    pair_ids = np.array(
+        [game.get_representative_pair_id(s) for s in profiles], dtype=np.int64
+    )
+
+    if psp_state is None:
+        psp_stats = new_psp_stats(
+            profiles,
+            schedule,
+            num_outcomes,
+            game["seed"] if seed is None else seed,
+            target_delta,
+        )
+        mark_determined_profiles(game, psp_stats, do_floor)
+    else:
+        psp_stats = resume_psp_stats(psp_state, profiles, schedule, target_epsilon)
+        psp_stats["delta"] += target_delta
+    psp_stats["rng_state"] = rng.bit_generator.state
+    U = psp_stats["U"]
+    V = psp_stats["V"]
+    epsilons = psp_stats["epsilons"]
+    num_samples = psp_stats["num_samples"]
+    # The number of strategies of each player, i.e., of pairs of discard choice and bet.
+    num_strategies = len(game["index_discards"]) * len(game["bet_grid"])
+
+    # A continued run can eliminate strategies given the confidence intervals it starts with.
+    if eliminate_dominated:
+        psp_stats["eliminated"] = eliminate_dominated_strategies(
+            psp_stats["estimates"], epsilons, num_strategies
+        )
+        psp_stats["active"] &= ~psp_stats["eliminated"]
+
+    # Skip the iterations with no more samples than the active profiles already have.
+    first_t = 1
+    if psp_stats["active"].any():
+        first_t += sum(m <= num_samples[psp_stats["active"]].max() for m in schedule)
+    else:
+        psp_stats["stop_reason"] = "converged"
+    if first_t > T:
+        psp_stats["stop_reason"] = "schedule_end"
+    if psp_stats["stop_reason"] is not None:
+        psp_stats["epsilon"] = float(epsilons.max())
+        yield build_psp_maps(psp_stats)
+        return
+
+    # Iterate as per the schedule
+    for t in range(first_t, T + 1):
+
+        # Compute number of samples: each active profile gets schedule[t - 1] samples in all, so the samples to draw
+        # are those of the active profiles with the fewest.
+        active_indices = np.flatnonzero(psp_stats["active"])
+        m_marginal = schedule[t - 1] - int(num_samples[active_indices].min())
+        num_active = len(active_indices)
+
+        # Stop if the iteration would exceed the budget.
+        if deadline is not None and time.time() >= deadline:
+            psp_stats["stop_reason"] = "deadline"
+        elif (
+            max_simulations is not None
+            and psp_stats["emp_simulation_complexity"]
+            + (
+                num_outcomes * num_active
+                if m_marginal > num_outcomes
+                else int((schedule[t - 1] - num_samples[active_indices]).sum())
+            )
+            > max_simulations
+        ):
+            psp_stats["stop_reason"] = "max_simulations"
+        if psp_stats["stop_reason"] is not None:
+            yield build_psp_maps(psp_stats)
+            return
+
+        # If there are more samples to draw than distinct outcomes, evaluate every outcome instead, and stop.
+        if m_marginal > num_outcomes:
+            t0 = time.perf_counter()
+            psp_exact(game, psp_stats, do_floor)
+            psp_stats["epsilon"] = float(epsilons.max())
+            psp_stats["stop_reason"] = "exact"
+            if callback is not None:
+                callback(
+                    {
+                        "t": t,
+                        "exact": True,
+                        "num_outcomes": num_outcomes,
+                        "active_set_len": num_active,
+                        "seconds": {"exact": time.perf_counter() - t0},
+                    }
+                )
+            yield build_psp_maps(psp_stats)
+            return
+
+        m = schedule[t - 1]
 
         # Record number of samples used - sample complexity
-        psp_stats["emp_sample_complexity"] = m
+        psp_stats["emp_sample_complexity"] += m_marginal
 
         # Draw randomness. In poker, draw dealer cards.
-        random_cards = draw_randomness(game, m_marginal)
+        t0 = time.perf_counter()
+        random_cards = draw_dealer_cards(game, m_marginal, rng)
+        psp_stats["rng_state"] = rng.bit_generator.state
+        t1 = time.perf_counter()
+
+        # A player's completed hand only depends on the player's discard choice, so score once each kept hand
+        # still needed by the active set. Profiles are grouped by representative pair and number of samples.
+        active_groups, group_of_active = np.unique(
+            np.column_stack([pair_ids[active_indices], num_samples[active_indices]]),
+            axis=0,
+            return_inverse=True,
+        )
+        active_index_discards = [
+            game.get_index_discards(pair_id) for pair_id in active_groups[:, 0].tolist()
+        ]
+        p1_ordinals = score_kept_hands(
+            game, "p1", {d[0] for d in active_index_discards}, random_cards, do_floor
+        )
+        p2_ordinals = score_kept_hands(
+            game, "p2", {d[1] for d in active_index_discards}, random_cards, do_floor
+        )
+        t2 = time.perf_counter()
 
         # Account for the active set
-        psp_stats["active_set_len"].append(len(active_set))
+        psp_stats["active_set_len"].append(num_active)
 
         # Simulation complexity: sum of the number of samples processed times the number of strategy profiles that are active
-        psp_stats["emp_simulation_complexity"] += m_marginal * len(active_set)
-
-        # Loop through every active strategy profile, s.
-        for s in active_set:
+        psp_stats["emp_simulation_complexity"] += int(
+            (m - num_samples[active_indices]).sum()
+        )
 
-            # Simulate game, that is, complete hands and score them.
-            total_sum_p1_points, total_sum_p1_points_squared = simulate_game(
-                strategy_profile=s,
-                game=game,
-                list_of_dealer_cards=random_cards,
-                do_floor=do_floor,
+        # Simulate the game, that is, compare the scores of the completed hands, once for each group of the active
+        # set, on the samples its profiles need, and accumulate stats.
+        group_sums = np.zeros((len(active_groups), 2), dtype=np.int64)
+        for group, (p1_index_discard, p2_index_discard) in enumerate(
+            active_index_discards
+        ):
+            group_marginal = m - int(active_groups[group, 1])
+            group_sums[group] = simulate_game_from_ordinals(
+                p1_ordinals[p1_index_discard][:group_marginal],
+                p2_ordinals[p2_index_discard][:group_marginal],
             )
+        U[active_indices] += group_sums[group_of_active.ravel(), 0]
+        V[active_indices] += group_sums[group_of_active.ravel(), 1]
+        num_samples[active_indices] = m
+        t3 = time.perf_counter()
+
+        # Compute and store epsilon for the active strategy profiles.
+        update_estimates(psp_stats, active_indices, m, bound, t)
+        t4 = time.perf_counter()
+
+        # Prune well-estimated strategy profiles, and those with a dominated strategy.
+        psp_stats["active"] = psp_stats["active"] & (epsilons > target_epsilon)
+        if eliminate_dominated:
+            psp_stats["eliminated"] = eliminate_dominated_strategies(
+                psp_stats["estimates"], epsilons, num_strategies
+            )
+            psp_stats["active"] &= ~psp_stats["eliminated"]
+        t5 = time.perf_counter()
+
+        if callback is not None:
+            callback(
+                get_iteration_metrics(
+                    t,
+                    m,
+                    m_marginal,
+                    epsilons[active_indices],
+                    int(np.count_nonzero(psp_stats["active"])),
+                    {
+                        "sample": t1 - t0,
+                        "score": t2 - t1,
+                        "simulate": t3 - t2,
+                        "compute_stats": t4 - t3,
+                        "prune": t5 - t4,
+                    },
+                )
+            )
+        psp_stats["epsilon"] = float(epsilons.max())
+
+        # If there are no more active strategy profiles, stop.
+        if not psp_stats["active"].any():
+            psp_stats["stop_reason"] = "converged"
+        elif t == T:
+            psp_stats["stop_reason"] = "schedule_end"
+        if psp_stats["stop_reason"] is not None:
+            yield build_psp_maps(psp_stats)
+            return
+        yield snapshot_psp_stats(psp_stats)
+
+
+def psp_sweep(
+    game,
+    target_epsilons_and_betas,
+    target_delta,
+    c=2.0,
+    do_floor=False,
+    seed=None,
+    chunk_size=2 ** 16,
+    bound="union",
+):
+    """
+    Runs PSP on a game for several pairs of target epsilon and beta, sharing one stream of dealer cards. At the end of
+    each iteration, a run uses the first samples of the stream, as many as its schedule says, instead of drawing its
+    own, so the stream is only as long as the longest run. Each sample is simulated once for all runs, for the
+    strategy profiles still active in some run, so the sweep costs about as much as its most expensive run.
+    Each run has the guarantees of PSP, and its statistics, e.g., emp_sample_complexity and emp_simulation_complexity,
+    are those PSP would report on the shared stream, though they are not those of psp with the same seed, which draws
+    each iteration's samples separately. Runs are not independent of each other.
+    :param game: a poker game.
+    :param target_epsilons_and_betas: a list of pairs (target_epsilon, beta).
+    :param target_delta: the target failure probability of each run.
+    :param c: the range of the payoffs.
+    :param do_floor: floors card scores.
+    :param seed: the seed of the random number generator that draws the stream. If None, the game's.
+    :param chunk_size: the maximum number of draws of dealer cards processed at once.
+    :param bound: the name of the bound of the runs, a key of BOUNDS.
+    :return: a map from each pair (target_epsilon, beta) to the statistics of its run, as returned by psp.
+    """
+    rng = game["rng"] if seed is None else np.random.default_rng(seed)
+    profiles = list(game["strategy_profiles"].keys())
+    pair_ids = np.array(
+        [game.get_representative_pair_id(s) for s in profiles], dtype=np.int64
+    )
+    num_outcomes = comb(len(game["deck"]), game["num_discard_cards"])
 
-            # Accumulate stats.
-            stats[s]["U"] = stats[s]["U"] + total_sum_p1_points
-            stats[s]["V"] = stats[s]["V"] + total_sum_p1_points_squared
-
-            # Compute and store epsilon for this strategy profile.
-            psp_stats["epsilon_map"][s] = compute_stats(
-                stats[s]["U"],
-                stats[s]["V"],
-                m,
-                c,
+    runs = {}
+    for target_epsilon, beta in target_epsilons_and_betas:
+        run_bound = BOUNDS[bound](
+            target_epsilon, target_delta, c, beta, game["size_of_game"], num_outcomes
+        )
+        runs[(target_epsilon, beta)] = {
+            "t": 1,
+            "m": 0,
+            "bound": run_bound,
+            "psp_stats": new_psp_stats(
+                profiles,
+                run_bound.schedule,
+                num_outcomes,
+                game["seed"] if seed is None else seed,
                 target_delta,
-                T,
-                game["size_of_game"],
-            )
+            ),
+        }
+        mark_determined_profiles(
+            game, runs[(target_epsilon, beta)]["psp_stats"], do_floor
+        )
 
-            psp_stats["estimate_map"][s] = stats[s]["U"] / m
-            psp_stats["variance_map"][s] = (stats[s]["V"] - stats[s]["U"] ** 2 / m) / (
-                m - 1
+    # The runs whose strategy profiles are all determined converge without sampling, as in psp.
+    pending = {}
+    for key, run in runs.items():
+        psp_stats = run["psp_stats"]
+        if psp_stats["active"].any():
+            pending[key] = run
+        else:
+            psp_stats["epsilon"] = float(psp_stats["epsilons"].max())
+            psp_stats["stop_reason"] = "converged"
+            psp_stats["rng_state"] = rng.bit_generator.state
+            build_psp_maps(psp_stats)
+
+    # The sums of payoffs and of squared payoffs of each representative pair over the first stream_length samples of
+    # the stream. Pairs no run needs anymore are not updated.
+    pair_sums = np.zeros((len(game["index_discards"]) ** 2, 2), dtype=np.int64)
+    stream_length = 0
+    exact_sums = None
+
+    while len(pending) > 0:
+        # If a run has more samples to draw than distinct outcomes, it evaluates every outcome instead, and stops.
+        # Outcomes are evaluated once, for every strategy profile.
+        for key, run in list(pending.items()):
+            psp_stats = run["psp_stats"]
+            if psp_stats["schedule"][run["t"] - 1] - run["m"] > num_outcomes:
+                if exact_sums is None:
+                    exact_sums = compute_exact_sums(game, profiles, do_floor)
+                psp_exact(game, psp_stats, do_floor, exact_sums)
+                psp_stats["epsilon"] = float(psp_stats["epsilons"].max())
+                psp_stats["stop_reason"] = "exact"
+                psp_stats["rng_state"] = rng.bit_generator.state
+                build_psp_maps(psp_stats)
+                del pending[key]
+        if len(pending) == 0:
+            break
+
+        # Extend the stream up to the next iteration of any run, for the pairs active in some run.
+        next_m = min(
+            run["psp_stats"]["schedule"][run["t"] - 1] for run in pending.values()
+        )
+        needed_pair_ids = np.unique(
+            np.concatenate(
+                [pair_ids[run["psp_stats"]["active"]] for run in pending.values()]
+            )
+        )
+        needed_index_discards = [
+            game.get_index_discards(pair_id) for pair_id in needed_pair_ids.tolist()
+        ]
+        for start in range(stream_length, next_m, chunk_size):
+            random_cards = draw_dealer_cards(game, min(chunk_size, next_m - start), rng)
+            p1_ordinals = score_kept_hands(
+                game,
+                "p1",
+                {d[0] for d in needed_index_discards},
+                random_cards,
+                do_floor,
             )
+            p2_ordinals = score_kept_hands(
+                game,
+                "p2",
+                {d[1] for d in needed_index_discards},
+                random_cards,
+                do_floor,
+            )
+            for pair_id, (p1_index_discard, p2_index_discard) in zip(
+                needed_pair_ids.tolist(), needed_index_discards
+            ):
+                pair_sums[pair_id] += simulate_game_from_ordinals(
+                    p1_ordinals[p1_index_discard], p2_ordinals[p2_index_discard]
+                )
+        stream_length = next_m
+
+        # Run the iteration of every run that ends here.
+        for (target_epsilon, beta), run in list(pending.items()):
+            psp_stats = run["psp_stats"]
+            m = psp_stats["schedule"][run["t"] - 1]
+            if m != next_m:
+                continue
+            active_indices = np.flatnonzero(psp_stats["active"])
+            psp_stats["emp_sample_complexity"] = m
+            psp_stats["active_set_len"].append(len(active_indices))
+            psp_stats["emp_simulation_complexity"] += (m - run["m"]) * len(
+                active_indices
+            )
+            psp_stats["U"][active_indices] = pair_sums[pair_ids[active_indices], 0]
+            psp_stats["V"][active_indices] = pair_sums[pair_ids[active_indices], 1]
+            psp_stats["num_samples"][active_indices] = m
+            update_estimates(psp_stats, active_indices, m, run["bound"], run["t"])
+            psp_stats["active"] = psp_stats["active"] & (
+                psp_stats["epsilons"] > target_epsilon
+            )
+            psp_stats["epsilon"] = float(psp_stats["epsilons"].max())
+            run["m"] = m
+            run["t"] += 1
 
-        # Prune well-estimated strategy profiles.
-        active_set = {
-            strategy_profile
-            for strategy_profile in active_set
-            if psp_stats["epsilon_map"][strategy_profile] > target_epsilon
-        }
+            if not psp_stats["active"].any():
+                psp_stats["stop_reason"] = "converged"
+            elif run["t"] > len(psp_stats["schedule"]):
+                psp_stats["stop_reason"] = "schedule_end"
+            if psp_stats["stop_reason"] is not None:
+                psp_stats["rng_state"] = rng.bit_generator.state
+                build_psp_maps(psp_stats)
+                del pending[(target_epsilon, beta)]
+
+    return {key: run["psp_stats"] for key, run in runs.items()}
 
-        # If there are no more active strategy profiles, return
-        if len(active_set) == 0:
-            return psp_stats
 
+def new_psp_stats(profiles, schedule, num_outcomes, seed, delta):
+    """
+    :param profiles: the strategy profiles of the game.
+    :param schedule: the number of samples of each iteration.
+    :param num_outcomes: the number of distinct draws of dealer cards.
+    :param seed: the seed of the random number generator that draws dealer cards.
+    :param delta: the target failure probability of the run.
+    :return: the statistics of a psp run that has not drawn any samples yet.
+    """
+    return {
+        "schedule": schedule,
+        "active_set_len": [],
+        "emp_simulation_complexity": 0,
+        "emp_sample_complexity": 0,
+        "num_outcomes": num_outcomes,
+        # The seed of the random number generator that drew dealer cards, and its state, from which a run that
+        # continues this one draws.
+        "seed": seed,
+        "rng_state": None,
+        # The failure probability of the epsilons, summed over this run and the runs it continues.
+        "delta": delta,
+        # Whether the remaining active profiles were evaluated exactly over all outcomes.
+        "exact": False,
+        # The state of the run, as arrays indexed like profiles: the sums of payoffs and of squared payoffs, and the
+        # number of samples they are over, the epsilons, estimates and variances, and whether each strategy profile
+        # is active. The maps of strategy profiles, e.g., epsilon_map, are built from them when PSP stops, see
+        # build_psp_maps.
+        "profiles": profiles,
+        "U": np.zeros(len(profiles), dtype=np.int64),
+        "V": np.zeros(len(profiles), dtype=np.int64),
+        "num_samples": np.zeros(len(profiles), dtype=np.int64),
+        "epsilons": np.full(len(profiles), math.inf),
+        "estimates": np.zeros(len(profiles)),
+        "variances": np.zeros(len(profiles)),
+        "active": np.ones(len(profiles), dtype=bool),
+        # Whether a player plays an eliminated strategy in each strategy profile, see eliminate_dominated_strategies.
+        "eliminated": np.zeros(len(profiles), dtype=bool),
+        # The largest epsilon over all strategy profiles.
+        "epsilon": math.inf,
+        "stop_reason": None,
+        # The number of strategy profiles whose payoff does not depend on dealer cards, see mark_determined_profiles.
+        "num_determined": 0,
+    }
+
+
+def mark_determined_profiles(game, psp_stats, do_floor):
+    """
+    Marks the strategy profiles whose payoff is the same for every draw of dealer cards as evaluated exactly, and
+    inactive, so they are never sampled, see Game.compute_determined_payoffs. Finding them scores each kept hand
+    over every outcome, once per game, but simulates no profile, so it is not counted in the empirical complexities.
+    :param game: a poker game.
+    :param psp_stats: the statistics of a psp run that has not drawn any samples yet, which are updated.
+    :param do_floor: floors card scores.
+    """
+    determined_payoffs = game.get_determined_payoffs(do_floor)
+    determined = ~np.isnan(determined_payoffs)
+    payoffs = determined_payoffs[determined].astype(np.int64)
+    psp_stats["U"][determined] = payoffs * psp_stats["num_outcomes"]
+    psp_stats["V"][determined] = payoffs ** 2 * psp_stats["num_outcomes"]
+    psp_stats["num_samples"][determined] = psp_stats["num_outcomes"]
+    psp_stats["epsilons"][determined] = 0.0
+    psp_stats["estimates"][determined] = payoffs
+    psp_stats["variances"][determined] = 0.0
+    psp_stats["active"][determined] = False
+    psp_stats["num_determined"] = int(determined.sum())
+
+
+def resume_psp_stats(psp_state, profiles, schedule, target_epsilon):
+    """
+    :param psp_state: the statistics of a previous psp run, which are copied.
+    :param profiles: the strategy profiles of the game.
+    :param schedule: the schedule of the new run.
+    :param target_epsilon: the target error of the new run.
+    :return: the statistics of a psp run that continues the previous one, with the profiles whose epsilon exceeds
+    target_epsilon active.
+    """
+    if list(psp_state["profiles"]) != profiles:
+        raise ValueError("the psp state is not that of a run on this game")
+    psp_stats = {
+        key: value for key, value in psp_state.items() if key not in PSP_MAP_KEYS
+    }
+    for key in PSP_ARRAY_KEYS:
+        psp_stats[key] = np.array(psp_state[key])
+    psp_stats["schedule"] = schedule
+    psp_stats["active_set_len"] = list(psp_state["active_set_len"])
+    psp_stats["active"] = psp_stats["epsilons"] > target_epsilon
+    psp_stats["stop_reason"] = None
     return psp_stats
 
 
+def save_psp_state(path, psp_stats):
+    """
+    Writes the state of a psp run as JSON, so that a later run can continue it (see psp_iter).
+    :param path: the path of the file.
+    :param psp_stats: the statistics of a psp run.
+    """
+    state = {key: value for key, value in psp_stats.items() if key not in PSP_MAP_KEYS}
+    for key in PSP_ARRAY_KEYS:
+        state[key] = psp_stats[key].tolist()
+    with open(path, "w") as state_file:
+        json.dump(state, state_file)
+
+
+def load_psp_state(path):
+    """
+    Reads the state of a psp run written by save_psp_state.
+    :param path: the path of the file.
+    :return: the statistics of the run.
+    """
+    with open(path) as state_file:
+        psp_stats = json.load(state_file)
+    psp_stats["profiles"] = [
+        (tuple(p1_index_discard), p1_bet, tuple(p2_index_discard), p2_bet)
+        for p1_index_discard, p1_bet, p2_index_discard, p2_bet in psp_stats["profiles"]
+    ]
+    for key, dtype in PSP_ARRAY_KEYS.items():
+        psp_stats[key] = np.array(psp_stats[key], dtype=dtype)
+    return build_psp_maps(psp_stats)
+
+
+def update_estimates(psp_stats, active_indices, m, bound, t):
+    """
+    Computes the epsilons, estimates and variances of the given profiles from their sums over m samples.
+    :param psp_stats: the statistics of the psp run, which are updated.
+    :param active_indices: the indices of the profiles to update.
+    :param bound: the bound of the run, e.g., a UnionBound.
+    :param t: the iteration of the run.
+    """
+    U = psp_stats["U"][active_indices]
+    V = psp_stats["V"][active_indices]
+    psp_stats["epsilons"][active_indices] = bound.compute_epsilons(U, V, m, t)
+    psp_stats["estimates"][active_indices] = U / m
+    psp_stats["variances"][active_indices] = (V - U.astype(np.float64) ** 2 / m) / (
+        m - 1
+    )
+
+
+def eliminate_dominated_strategies(estimates, epsilons, num_strategies):
+    """
+    Iteratively eliminates the strategies of each player that are dominated given the confidence intervals of the
+    estimates. A strategy of player 1 is dominated if, against every remaining strategy of player 2, another remaining
+    strategy of player 1 has a lower confidence bound above its upper confidence bound; likewise for player 2, whose
+    payoffs are the opposite of player 1's. If the confidence intervals hold, eliminated strategies are iteratively
+    strictly dominated in the game, so none is a best response to the remaining strategies, and the eliminated
+    profiles are not needed to check that a profile of the remaining strategies is an epsilon-Nash equilibrium.
+    :param estimates: an array with the estimates of player 1's payoffs, indexed like the game's strategy profiles.
+    :param epsilons: an array with the epsilons of the estimates.
+    :param num_strategies: the number of strategies of each player.
+    :return: a boolean array indexed like the strategy profiles, true where a player plays an eliminated strategy.
+    """
+    lower = (estimates - epsilons).reshape(num_strategies, num_strategies)
+    upper = (estimates + epsilons).reshape(num_strategies, num_strategies)
+    remaining_p1 = np.ones(num_strategies, dtype=bool)
+    remaining_p2 = np.ones(num_strategies, dtype=bool)
+    while True:
+        # dominated[a, b] is whether strategy a is dominated by strategy b.
+        dominated_p1 = (
+            lower[None, :, remaining_p2] - upper[:, None, remaining_p2]
+        ).min(axis=2) > 0
+        dominated_p2 = (
+            lower[remaining_p1, :].T[:, None, :] - upper[remaining_p1, :].T[None, :, :]
+        ).min(axis=2) > 0
+        new_remaining_p1 = remaining_p1 & ~(dominated_p1 & remaining_p1).any(axis=1)
+        new_remaining_p2 = remaining_p2 & ~(dominated_p2 & remaining_p2).any(axis=1)
+        if (new_remaining_p1 == remaining_p1).all() and (
+            new_remaining_p2 == remaining_p2
+        ).all():
+            break
+        remaining_p1, remaining_p2 = new_remaining_p1, new_remaining_p2
+    return ~(remaining_p1[:, None] & remaining_p2[None, :]).ravel()
+
+
+def build_psp_maps(psp_stats):
+    """
+    Builds the maps from strategy profiles of a psp run, i.e., stats, epsilon_map, estimate_map and variance_map,
+    and its active_set, from its arrays.
+    :param psp_stats: the statistics of the psp run, which are updated.
+    :return: psp_stats.
+    """
+    profiles = psp_stats["profiles"]
+    psp_stats["stats"] = {
+        s: {"U": U, "V": V}
+        for s, U, V in zip(profiles, psp_stats["U"].tolist(), psp_stats["V"].tolist())
+    }
+    psp_stats["epsilon_map"] = dict(zip(profiles, psp_stats["epsilons"].tolist()))
+    psp_stats["estimate_map"] = dict(zip(profiles, psp_stats["estimates"].tolist()))
+    psp_stats["variance_map"] = dict(zip(profiles, psp_stats["variances"].tolist()))
+    psp_stats["active_set"] = frozenset(
+        profiles[i] for i in np.flatnonzero(psp_stats["active"])
+    )
+    # A Nash equilibrium of the empirical game restricted to the strategies that are not eliminated is an
+    # epsilon-Nash equilibrium of the game, for twice the largest epsilon of its profiles.
+    psp_stats["nash_epsilon"] = 2 * float(
+        psp_stats["epsilons"][~psp_stats["eliminated"]].max()
+    )
+    return psp_stats
+
+
+def snapshot_psp_stats(psp_stats):
+    """
+    Copies the statistics of a psp run that is still running, so that its later iterations do not modify the copy,
+    and builds the copy's maps (see build_psp_maps).
+    :param psp_stats: the statistics of the psp run.
+    :return: the copy.
+    """
+    snapshot = dict(psp_stats)
+    for key in PSP_ARRAY_KEYS:
+        snapshot[key] = psp_stats[key].copy()
+    snapshot["active_set_len"] = list(psp_stats["active_set_len"])
+    return build_psp_maps(snapshot)
+
+
+def psp_exact(game, psp_stats, do_floor, exact_sums=None):
+    """
+    Computes the exact statistics of the active profiles by evaluating every outcome, i.e., every draw of dealer
+    cards, so that their estimation error is zero. Each outcome counts as one sample in the empirical complexities.
+    :param game: a poker game.
+    :param psp_stats: the statistics of the psp run so far, which are updated. Its active profiles are evaluated.
+    :param do_floor: floors card scores.
+    :param exact_sums: the sums of the active profiles, as returned by stats.compute_exact_sums, if they are already
+    computed.
+    :return: psp_stats.
+    """
+    active_indices = np.flatnonzero(psp_stats["active"])
+    if exact_sums is None:
+        exact_sums = compute_exact_sums(
+            game, [psp_stats["profiles"][i] for i in active_indices], do_floor
+        )
+    sums, num_outcomes = exact_sums
+
+    psp_stats["exact"] = True
+    psp_stats["active_set_len"].append(len(active_indices))
+    psp_stats["emp_sample_complexity"] += num_outcomes
+    psp_stats["emp_simulation_complexity"] += num_outcomes * len(active_indices)
+
+    for i in active_indices:
+        total_sum_p1_points, total_sum_p1_points_squared = sums[
+            psp_stats["profiles"][i]
+        ]
+        mean = total_sum_p1_points / num_outcomes
+        psp_stats["epsilons"][i] = 0.0
+        psp_stats["estimates"][i] = mean
+        psp_stats["variances"][i] = (
+            total_sum_p1_points_squared / num_outcomes - mean ** 2
+        )
+        psp_stats["U"][i] = total_sum_p1_points
+        psp_stats["V"][i] = total_sum_p1_points_squared
+        psp_stats["num_samples"][i] = num_outcomes
+    psp_stats["active"] = np.zeros(len(psp_stats["profiles"]), dtype=bool)
+
+    return psp_stats
+
+
+def get_iteration_metrics(t, m, m_marginal, epsilons, num_active_after, seconds):
+    """
+    Computes the metrics of an iteration of psp's schedule.
+    :param t: the iteration.
+    :param m: the number of samples drawn so far.
+    :param m_marginal: the number of samples drawn in this iteration.
+    :param epsilons: the epsilons of the strategy profiles active in this iteration.
+    :param num_active_after: the number of strategy profiles still active after pruning.
+    :param seconds: a map from each phase of the iteration to the seconds it took.
+    :return: a dictionary that can be written as JSON.
+    """
+    quantiles = np.quantile(epsilons, [0.0, 0.25, 0.5, 0.75, 1.0])
+    return {
+        "t": t,
+        "exact": False,
+        "m": m,
+        "m_marginal": m_marginal,
+        "active_set_len": len(epsilons),
+        "active_set_len_after_pruning": num_active_after,
+        "seconds": seconds,
+        "samples_per_second": m_marginal / sum(seconds.values()),
+        "epsilon": dict(
+            zip(["min", "q25", "median", "q75", "max"], quantiles.tolist())
+        ),
+    }
+
+
+def write_psp_metrics(path, **fields):
+    """
+    Makes a psp callback that appends the metrics of each iteration to a JSON lines file.
+    :param path: the JSON lines file.
+    :param fields: fields added to every line, e.g., the game's id and the seed.
+    :return: the callback.
+    """
+
+    def callback(metrics):
+        with open(path, "a") as metrics_file:
+            metrics_file.write(json.dumps({**fields, **metrics}) + "\n")
+
+    return callback
+
+
 if __name__ == "__main__":
 
     # Draw a game.
@@ -0,0 +1,195 @@
+import argparse
+import json
+import platform
+import random
+import sys
+import time
+
+import numpy as np
+
+from algorithms import psp
+from poker import (
+    draw_dealer_cards,
+    draw_randomness,
+    sample_game,
+    simulate_game,
+    simulate_game_batch,
+)
+from score_hands import get_hand_score, load_rank_table
+from stats import compute_game_stats
+
+# Parameters of the benchmarks, those of the experiments in experiments.py.
+BENCHMARK_SEED = 0
+BENCHMARK_TARGET_EPSILON = 0.01
+BENCHMARK_TARGET_DELTA = 0.05
+BENCHMARK_BETA = 1.1
+BENCHMARK_NUM_DISCARD_CARDS_GRID = [1, 2, 3]
+
+
+def best_time(function, repeat):
+    """
+    Times a function.
+    :param function: a function without arguments.
+    :param repeat: how many times to run the function.
+    :return: the least number of seconds the function took.
+    """
+    seconds = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        function()
+        seconds.append(time.perf_counter() - t0)
+    return min(seconds)
+
+
+def benchmark_game(num_discard_cards):
+    """
+    :return: the fixed game on which benchmarks with num_discard_cards are run.
+    """
+    random.seed(BENCHMARK_SEED + num_discard_cards)
+    return sample_game(
+        num_discard_cards=num_discard_cards, seed=BENCHMARK_SEED + num_discard_cards
+    )
+
+
+def benchmark_rank_table_load(repeat):
+    return {"rank_table_load_seconds": best_time(load_rank_table, repeat)}
+
+
+def benchmark_get_hand_score(repeat, number_of_hands=20000):
+    game = benchmark_game(num_discard_cards=2)
+    deck = game["deck"] + game["hand_p1"] + game["hand_p2"]
+    random.seed(BENCHMARK_SEED)
+    hands = [random.sample(deck, 5) for _ in range(number_of_hands)]
+    return {
+        f"get_hand_score_{do_floor}_per_second": number_of_hands
+        / best_time(lambda: [get_hand_score(hand, do_floor) for hand in hands], repeat)
+        for do_floor in [False, True]
+    }
+
+
+def benchmark_simulate_game(repeat, number_of_samples=2000):
+    game = benchmark_game(num_discard_cards=2)
+    strategy_profile = next(iter(game["strategy_profiles"]))
+    dealer_cards = draw_dealer_cards(
+        game, number_of_samples, np.random.default_rng(BENCHMARK_SEED)
+    )
+    list_of_dealer_cards = draw_randomness(
+        game, number_of_samples, np.random.default_rng(BENCHMARK_SEED)
+    )
+    return {
+        "simulate_game_per_second": number_of_samples
+        / best_time(
+            lambda: simulate_game(strategy_profile, game, list_of_dealer_cards, False),
+            repeat,
+        ),
+        "simulate_game_batch_per_second": number_of_samples
+        / best_time(
+            lambda: simulate_game_batch(strategy_profile, game, dealer_cards, False),
+            repeat,
+        ),
+    }
+
+
+def benchmark_psp(repeat):
+    results = {}
+    for num_discard_cards in BENCHMARK_NUM_DISCARD_CARDS_GRID:
+        game = benchmark_game(num_discard_cards)
+        results[f"psp_{num_discard_cards}_seconds"] = best_time(
+            lambda: psp(
+                game,
+                BENCHMARK_TARGET_EPSILON,
+                BENCHMARK_TARGET_DELTA,
+                beta=BENCHMARK_BETA,
+                seed=BENCHMARK_SEED,
+            ),
+            repeat,
+        )
+    return results
+
+
+def benchmark_compute_game_stats(repeat):
+    results = {}
+    for num_discard_cards in BENCHMARK_NUM_DISCARD_CARDS_GRID:
+        game = benchmark_game(num_discard_cards)
+        results[f"compute_game_stats_{num_discard_cards}_seconds"] = best_time(
+            lambda: compute_game_stats(game, do_floor=False), repeat
+        )
+    return results
+
+
+BENCHMARKS = {
+    "rank_table_load": benchmark_rank_table_load,
+    "get_hand_score": benchmark_get_hand_score,
+    "simulate_game": benchmark_simulate_game,
+    "psp": benchmark_psp,
+    "compute_game_stats": benchmark_compute_game_stats,
+}
+
+
+def run_benchmarks(names=None, repeat=5):
+    """
+    Runs benchmarks. Measurements ending in _seconds are better when lower, and those ending in _per_second are
+    better when higher.
+    :param names: the names of the benchmarks to run, keys of BENCHMARKS. If None, all of them.
+    :param repeat: how many times to run each measurement; the best time is kept.
+    :return: a dictionary with the machine and the measurements.
+    """
+    # Load the rank table before timing anything else.
+    get_hand_score(["H2", "S3", "C4", "D5", "H7"], False)
+    measurements = {}
+    for name in BENCHMARKS if names is None else names:
+        measurements.update(BENCHMARKS[name](repeat))
+    return {
+        "machine": {
+            "platform": platform.platform(),
+            "processor": platform.processor(),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+        },
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "repeat": repeat,
+        "measurements": measurements,
+    }
+
+
+def compare_to_baseline(results, baseline):
+    """
+    Compares measurements to those of a baseline.
+    :param results: a dictionary returned by run_benchmarks.
+    :param baseline: a dictionary returned by run_benchmarks, e.g., before a change.
+    :return: a dictionary with the speedup of each measurement found in both, greater than 1 if it got faster.
+    """
+    speedups = {}
+    for name, value in results["measurements"].items():
+        baseline_value = baseline["measurements"].get(name)
+        if baseline_value is None:
+            continue
+        if name.endswith("_per_second"):
+            speedups[name] = value / baseline_value
+        else:
+            speedups[name] = baseline_value / value
+    return speedups
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Times scoring, simulation, psp and exact game stats, and writes the measurements as JSON."
+    )
+    parser.add_argument("--output", help="where to write the measurements")
+    parser.add_argument("--baseline", help="measurements to compare with")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--only", nargs="+", choices=list(BENCHMARKS))
+    arguments = parser.parse_args()
+
+    benchmark_results = run_benchmarks(arguments.only, arguments.repeat)
+    if arguments.baseline is not None:
+        with open(arguments.baseline) as baseline_file:
+            benchmark_results["speedups"] = compare_to_baseline(
+                benchmark_results, json.load(baseline_file)
+            )
+
+    if arguments.output is not None:
+        with open(arguments.output, "w") as output_file:
+            json.dump(benchmark_results, output_file, indent=2)
+    json.dump(benchmark_results, sys.stdout, indent=2)
+    print()
@@ -0,0 +1,122 @@
+import argparse
+import ast
+
+import pandas as pd
+
+from algorithms import BOUNDS, psp
+from poker import create_game, get_deck
+
+# The bounds compared by default, as pairs (bound, beta): PSP's union bound with the beta of the experiments in
+# experiments.py, and the anytime bound, which can check pruning more often.
+DEFAULT_BOUNDS = [("union", 1.1), ("anytime", 1.1), ("anytime", 1.05)]
+
+
+def read_stored_games(do_floor):
+    """
+    Reads the games stored in results/games_do_floor_*.csv.
+    :param do_floor: which results to read.
+    :return: a list of pairs (row, game), where row is the game's row in the results.
+    """
+    games = []
+    for _, row in pd.read_csv(f"results/games_do_floor_{do_floor}.csv").iterrows():
+        hand_p1 = ast.literal_eval(row["hand_p1"])
+        hand_p2 = ast.literal_eval(row["hand_p2"])
+        game = create_game(
+            {
+                "deck": [card for card in get_deck() if card not in hand_p1 + hand_p2],
+                "num_discard_cards": int(row["num_discard_cards"]),
+                "hand_p1": hand_p1,
+                "hand_p2": hand_p2,
+                "bet_grid": ["*"],
+            }
+        )
+        games.append((row, game))
+    return games
+
+
+def compare_bounds(games, bounds, do_floor, seed=0):
+    """
+    Runs PSP with each bound on each game, with the game's target epsilon and delta.
+    :param games: a list of pairs (row, game), as returned by read_stored_games.
+    :param bounds: a list of pairs (bound, beta), where bound is a key of algorithms.BOUNDS.
+    :param do_floor: floors card scores.
+    :param seed: the seed of the i-th game's PSP runs is seed + i, the same for every bound.
+    :return: a DataFrame with one row per game and bound.
+    """
+    rows = []
+    for i, (row, game) in enumerate(games):
+        for bound, beta in bounds:
+            psp_stats = psp(
+                game,
+                row["target_epsilon"],
+                row["target_delta"],
+                beta=beta,
+                do_floor=do_floor,
+                seed=seed + i,
+                bound=bound,
+            )
+            rows.append(
+                {
+                    "game_id": row["game_id"],
+                    "num_discard_cards": game["num_discard_cards"],
+                    "target_epsilon": row["target_epsilon"],
+                    "bound": bound,
+                    "beta": beta,
+                    "emp_sample_complexity": psp_stats["emp_sample_complexity"],
+                    "emp_simulation_complexity": psp_stats["emp_simulation_complexity"],
+                    "epsilon": psp_stats["epsilon"],
+                    "stop_reason": psp_stats["stop_reason"],
+                }
+            )
+    return pd.DataFrame(rows)
+
+
+def summarize(comparison):
+    """
+    :param comparison: a DataFrame returned by compare_bounds.
+    :return: a DataFrame with the mean emp_simulation_complexity of each bound, by num_discard_cards, and its ratio
+    to that of the first bound.
+    """
+    summary = (
+        comparison.groupby(["num_discard_cards", "bound", "beta"], sort=False)[
+            "emp_simulation_complexity"
+        ]
+        .mean()
+        .reset_index()
+    )
+    summary["ratio"] = summary["emp_simulation_complexity"] / summary.groupby(
+        "num_discard_cards"
+    )["emp_simulation_complexity"].transform("first")
+    return summary
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compares the emp_simulation_complexity of PSP with different bounds on the games in results/."
+    )
+    parser.add_argument("--do-floor", action="store_true")
+    parser.add_argument("--limit", type=int, help="only the first games")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--bounds",
+        nargs="+",
+        help="pairs bound:beta, e.g., anytime:1.05",
+        default=[f"{bound}:{beta}" for bound, beta in DEFAULT_BOUNDS],
+    )
+    arguments = parser.parse_args()
+
+    compared_bounds = []
+    for argument in arguments.bounds:
+        bound_name, bound_beta = argument.split(":")
+        if bound_name not in BOUNDS:
+            parser.error(f"unknown bound {bound_name}, not one of {list(BOUNDS)}")
+        compared_bounds.append((bound_name, float(bound_beta)))
+
+    stored_games = read_stored_games(arguments.do_floor)[: arguments.limit]
+    bounds_comparison = compare_bounds(
+        stored_games, compared_bounds, arguments.do_floor, arguments.seed
+    )
+    bounds_comparison.to_csv(
+        f"results/bounds_do_floor_{arguments.do_floor}.csv", index=False
+    )
+    print(summarize(bounds_comparison).to_string(index=False))
@@ -1,10 +1,16 @@
 import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from pathlib import Path
 
 import pandas as pd
+import pyarrow as pa
 
-from algorithms import psp, compute_schedule_length
+from algorithms import psp, psp_sweep, compute_schedule_length
+from game_stats_cache import GameStatsCache
+from manifest import RunManifest
 from poker import *
+from results_sink import HAND_TYPE, ResultsSink
+from score_hands import SharedRankTable, attach_shared_rank_table
 from stats import (
     compute_game_stats,
     compute_v_inf,
@@ -12,18 +18,81 @@ from stats import (
     compute_bounds,
 )
 
+GAMES_SCHEMA = pa.schema(
+    [
+        ("game_id", pa.int64()),
+        ("size_of_game", pa.int64()),
+        ("num_discard_cards", pa.int64()),
+        ("hand_p1", HAND_TYPE),
+        ("hand_p2", HAND_TYPE),
+        ("target_epsilon", pa.float64()),
+        ("target_delta", pa.float64()),
+        ("v_inf", pa.float64()),
+        ("v_1_inf", pa.float64()),
+        ("sample_complexity", pa.int64()),
+        ("simulation_complexity", pa.int64()),
+        ("game_seed", pa.int64()),
+    ]
+)
 
-def generate_and_save_game(
-    num_discard_cards, target_epsilon, target_delta, beta, do_floor
-):
-    # Draw a random game.
-    game = sample_game(num_discard_cards=num_discard_cards)
-    # game = generate_rigged_game()
+PSP_RUNS_SCHEMA = pa.schema(
+    [
+        ("game_id", pa.int64()),
+        ("emp_sample_complexity", pa.int64()),
+        ("emp_simulation_complexity", pa.int64()),
+        ("psp_seed", pa.int64()),
+    ]
+)
+
+PSP_SWEEP_SCHEMA = pa.schema(
+    [
+        ("game_id", pa.int64()),
+        ("num_discard_cards", pa.int64()),
+        ("target_epsilon", pa.float64()),
+        ("beta", pa.float64()),
+        ("target_delta", pa.float64()),
+        ("sample_complexity", pa.int64()),
+        ("simulation_complexity", pa.int64()),
+        ("emp_sample_complexity", pa.int64()),
+        ("emp_simulation_complexity", pa.int64()),
+        ("epsilon", pa.float64()),
+        ("stop_reason", pa.string()),
+        ("game_seed", pa.int64()),
+        ("psp_seed", pa.int64()),
+    ]
+)
 
-    # Compute the game's stats.
-    game_stats = compute_game_stats(game=game, do_floor=do_floor)
-    v_inf = compute_v_inf(game_stats=game_stats)
-    v_1_inf = compute_v_1_inf(game_stats=game_stats)
+
+def get_results_sink(stem, schema, do_floor, on_flush=None):
+    """
+    :return: the ResultsSink of results/{stem}_do_floor_*, which also appends to the CSV, and flushes every row.
+    """
+    return ResultsSink(
+        f"results/{stem}_do_floor_{do_floor}",
+        schema,
+        csv_path=f"results/{stem}_do_floor_{do_floor}.csv",
+        batch_size=1,
+        on_flush=on_flush,
+    )
+
+
+def compute_norms(game, do_floor, game_stats_cache=None):
+    """
+    Computes the game's stats, or reads them from the cache.
+    :return: the v_inf and v_1_inf norms of the game.
+    """
+    if game_stats_cache is None:
+        game_stats = compute_game_stats(game=game, do_floor=do_floor)
+        return compute_v_inf(game_stats=game_stats), compute_v_1_inf(
+            game_stats=game_stats
+        )
+    return game_stats_cache.get_norms(game, do_floor)
+
+
+def compute_game_row(
+    game, target_epsilon, target_delta, beta, do_floor, game_stats_cache=None
+):
+    v_inf, v_1_inf = compute_norms(game, do_floor, game_stats_cache)
 
     # Compute sample complexity and Simulation complexity.
     sample_complexity, simulation_complexity = compute_bounds(
@@ -36,79 +105,417 @@ def generate_and_save_game(
         beta=beta,
     )
 
-    pd.DataFrame(
-        [
-            [
-                game["id"],
-                game["size_of_game"],
-                game["num_discard_cards"],
-                game["hand_p1"],
-                game["hand_p2"],
-                target_epsilon,
-                target_delta,
-                v_inf,
-                v_1_inf,
-                sample_complexity,
-                simulation_complexity,
-            ]
-        ]
-    ).to_csv(f"results/games_do_floor_{do_floor}.csv", mode="a", index=False, header=False)
+    return [
+        game["id"],
+        game["size_of_game"],
+        game["num_discard_cards"],
+        cards_to_indices(game["hand_p1"]).tolist(),
+        cards_to_indices(game["hand_p2"]).tolist(),
+        target_epsilon,
+        target_delta,
+        v_inf,
+        v_1_inf,
+        sample_complexity,
+        simulation_complexity,
+        game["seed"],
+    ]
+
+
+def generate_and_save_game(
+    num_discard_cards,
+    target_epsilon,
+    target_delta,
+    beta,
+    do_floor,
+    games_sink,
+    game_stats_cache=None,
+):
+    # Draw a random game.
+    game = sample_game(num_discard_cards=num_discard_cards)
+    # game = generate_rigged_game()
+
+    games_sink.append(
+        compute_game_row(
+            game, target_epsilon, target_delta, beta, do_floor, game_stats_cache
+        )
+    )
 
     return game
 
 
+def compute_psp_row(game, target_epsilon, target_delta, beta, do_floor, seed=None):
+    psp_stats = psp(
+        game, target_epsilon, target_delta, beta=beta, do_floor=do_floor, seed=seed
+    )
+    # pprint.pprint(psp_stats)
+    return [
+        game["id"],
+        psp_stats["emp_sample_complexity"],
+        psp_stats["emp_simulation_complexity"],
+        psp_stats["seed"],
+    ]
+
+
 def psp_run_and_save_stats(
-    game, target_epsilon, target_delta, number_psp_runs, beta, do_floor
+    game,
+    target_epsilon,
+    target_delta,
+    number_psp_runs,
+    beta,
+    do_floor,
+    psp_runs_sink,
 ):
 
     # Run PSP multiple times, collect and save stats.
-    results = []
     for _ in range(0, number_psp_runs):
-        psp_stats = psp(
-            game, target_epsilon, target_delta, beta=beta, do_floor=do_floor
+        psp_runs_sink.append(
+            compute_psp_row(game, target_epsilon, target_delta, beta, do_floor)
         )
-        # pprint.pprint(psp_stats)
-        results.append(
-            [
-                game["id"],
-                psp_stats["emp_sample_complexity"],
-                psp_stats["emp_simulation_complexity"],
+
+
+def sample_task_game(seed, num_discard_cards):
+    """
+    Draws the random game of a task. The game only depends on the seed, so it can be drawn again to resume a sweep.
+    :param seed: the seed of the random number generator of the task.
+    :param num_discard_cards: the number of cards each player discards.
+    :return: the game.
+    """
+    random.seed(seed)
+    return sample_game(num_discard_cards=num_discard_cards, seed=seed)
+
+
+def run_game_task(
+    seed,
+    num_discard_cards,
+    target_epsilon,
+    target_delta,
+    beta,
+    do_floor,
+    game_stats_cache=None,
+):
+    """
+    Draws a random game and computes its row of results/games_do_floor_*.csv. Runs in a worker process.
+    :param seed: the seed of the random number generator of this task.
+    :param game_stats_cache: a GameStatsCache, or None to always compute the game's stats.
+    :return: the game, its row, and how many seconds the task took.
+    """
+    t0 = time.time()
+    game = sample_task_game(seed, num_discard_cards)
+    game_row = compute_game_row(
+        game, target_epsilon, target_delta, beta, do_floor, game_stats_cache
+    )
+    return game, game_row, time.time() - t0
+
+
+def run_psp_task(seed, game, target_epsilon, target_delta, beta, do_floor):
+    """
+    Runs PSP once on a game and computes its row of results/psp_runs_do_floor_*.csv. Runs in a worker process.
+    :param seed: the seed of the random number generator of this task.
+    :return: the row.
+    """
+    return compute_psp_row(game, target_epsilon, target_delta, beta, do_floor, seed)
+
+
+def run_experiments_in_parallel(
+    number_of_games,
+    num_discard_cards_grid,
+    target_eps_grid,
+    target_delta,
+    number_psp_runs,
+    beta,
+    do_floor,
+    seed=None,
+    max_workers=None,
+    manifest_path=None,
+    game_stats_cache=None,
+):
+    """
+    Runs the games of an experiment, and the PSP runs on each game, in a pool of processes. Every task gets its own
+    seed, derived from the given seed, so the experiment is reproducible. Only this process writes to the results
+    sinks, as tasks complete, so rows are never interleaved.
+    The rank table is published once in shared memory, and workers attach to it.
+    If a manifest is given, every unit of work, i.e., a game's stats, with replica None, or one PSP run on a game, is
+    recorded in it once its row is written, as (game index, num_discard_cards, target_epsilon, replica). Running the
+    same experiment again with the same manifest only runs the units that are not recorded, with the same seeds.
+    :param seed: the seed from which all tasks' seeds are derived. If None, fresh entropy, or the manifest's.
+    :param max_workers: the number of processes. If None, one per core.
+    :param manifest_path: the path of the RunManifest of the experiment, or None.
+    :param game_stats_cache: a GameStatsCache shared by the workers, or None to always compute games' stats.
+    """
+    parameters = list(
+        it.product(range(number_of_games), num_discard_cards_grid, target_eps_grid)
+    )
+    manifest = RunManifest(
+        manifest_path,
+        {
+            "number_of_games": number_of_games,
+            "num_discard_cards_grid": num_discard_cards_grid,
+            "target_eps_grid": target_eps_grid,
+            "target_delta": target_delta,
+            "number_psp_runs": number_psp_runs,
+            "beta": beta,
+            "do_floor": do_floor,
+        },
+        seed,
+    )
+    with get_results_sink(
+        "games", GAMES_SCHEMA, do_floor, manifest.record
+    ) as games_sink, get_results_sink(
+        "psp_runs", PSP_RUNS_SCHEMA, do_floor, manifest.record
+    ) as psp_runs_sink, SharedRankTable() as shared_rank_table, ProcessPoolExecutor(
+        max_workers=max_workers,
+        initializer=attach_shared_rank_table,
+        initargs=(shared_rank_table.handle,),
+    ) as executor:
+        games_sink.recover(manifest)
+        psp_runs_sink.recover(manifest)
+        game_futures = {}
+        for (game_index, num_discard_cards, target_epsilon), game_seed_sequence in zip(
+            parameters, manifest.seed_sequence().spawn(len(parameters))
+        ):
+            game_seed, *psp_seeds = game_seed_sequence.generate_state(
+                1 + number_psp_runs
+            )
+            game_unit = (game_index, num_discard_cards, target_epsilon, None)
+            psp_units = [
+                ((game_index, num_discard_cards, target_epsilon, replica), psp_seed)
+                for replica, psp_seed in enumerate(psp_seeds)
+                if (game_index, num_discard_cards, target_epsilon, replica)
+                not in manifest
             ]
+            compute_game = game_unit not in manifest
+            if compute_game:
+                future = executor.submit(
+                    run_game_task,
+                    int(game_seed),
+                    num_discard_cards,
+                    target_epsilon,
+                    target_delta,
+                    beta,
+                    do_floor,
+                    game_stats_cache,
+                )
+            elif len(psp_units) > 0:
+                # The game's stats are done, so only draw the game again.
+                future = executor.submit(
+                    sample_task_game, int(game_seed), num_discard_cards
+                )
+            else:
+                continue
+            game_futures[future] = (game_unit, psp_units, compute_game)
+
+        psp_futures = {}
+        for future in as_completed(game_futures):
+            game_unit, psp_units, compute_game = game_futures[future]
+            if compute_game:
+                game, game_row, seconds = future.result()
+                games_sink.append(game_row, game_unit)
+                print(
+                    f"took {seconds : .2f} secs to run game with parameters: "
+                    f"exp_num_discard_cards = {game['num_discard_cards']}, "
+                    f"exp_target_epsilon = {game_unit[2]}"
+                )
+            else:
+                game = future.result()
+            for psp_unit, psp_seed in psp_units:
+                psp_future = executor.submit(
+                    run_psp_task,
+                    int(psp_seed),
+                    game,
+                    game_unit[2],
+                    target_delta,
+                    beta,
+                    do_floor,
+                )
+                psp_futures[psp_future] = psp_unit
+
+        for future in as_completed(psp_futures):
+            psp_runs_sink.append(future.result(), psp_futures[future])
+
+
+def compute_psp_sweep_rows(
+    game,
+    target_eps_grid,
+    beta_grid,
+    target_delta,
+    do_floor,
+    seed=None,
+    game_stats_cache=None,
+):
+    """
+    Runs PSP on a game for every target epsilon and beta of the grids, sharing one stream of samples (see
+    algorithms.psp_sweep), and computes the rows of results/psp_sweep_do_floor_*.csv.
+    :return: a map from each pair (target_epsilon, beta) to its row.
+    """
+    v_inf, v_1_inf = compute_norms(game, do_floor, game_stats_cache)
+    sweep = psp_sweep(
+        game,
+        list(it.product(target_eps_grid, beta_grid)),
+        target_delta,
+        do_floor=do_floor,
+        seed=seed,
+    )
+    rows = {}
+    for (target_epsilon, beta), psp_stats in sweep.items():
+        sample_complexity, simulation_complexity = compute_bounds(
+            schedule_length=compute_schedule_length(target_epsilon, beta=beta),
+            epsilon=target_epsilon,
+            delta=target_delta,
+            v_inf=v_inf,
+            v_1_inf=v_1_inf,
+            game=game,
+            beta=beta,
         )
+        rows[(target_epsilon, beta)] = [
+            game["id"],
+            game["num_discard_cards"],
+            target_epsilon,
+            beta,
+            target_delta,
+            sample_complexity,
+            simulation_complexity,
+            psp_stats["emp_sample_complexity"],
+            psp_stats["emp_simulation_complexity"],
+            psp_stats["epsilon"],
+            psp_stats["stop_reason"],
+            game["seed"],
+            psp_stats["seed"],
+        ]
+    return rows
 
-    # Save results.
-    results_df = pd.DataFrame(results)
-    results_df.to_csv(f"results/psp_runs_do_floor_{do_floor}.csv", mode="a", index=False, header=False)
+
+def run_psp_sweep_task(
+    game_seed,
+    psp_seed,
+    num_discard_cards,
+    target_eps_grid,
+    beta_grid,
+    target_delta,
+    do_floor,
+    game_stats_cache=None,
+):
+    """
+    Draws a random game and runs the PSP sweep on it. Runs in a worker process.
+    :return: the rows of the sweep (see compute_psp_sweep_rows), and how many seconds the task took.
+    """
+    t0 = time.time()
+    game = sample_task_game(game_seed, num_discard_cards)
+    rows = compute_psp_sweep_rows(
+        game,
+        target_eps_grid,
+        beta_grid,
+        target_delta,
+        do_floor,
+        psp_seed,
+        game_stats_cache,
+    )
+    return rows, time.time() - t0
+
+
+def run_psp_sweep_in_parallel(
+    number_of_games,
+    num_discard_cards_grid,
+    target_eps_grid,
+    beta_grid,
+    target_delta,
+    do_floor,
+    seed=None,
+    max_workers=None,
+    manifest_path=None,
+    game_stats_cache=None,
+):
+    """
+    Runs the sweep mode of the experiment in a pool of processes: on each game, PSP runs once for every target epsilon
+    and beta of the grids, on one shared stream of samples, so each game costs about as much as its tightest run. Rows
+    go to results/psp_sweep_do_floor_*. Seeds, the shared rank table and the manifest are as in
+    run_experiments_in_parallel; a unit is (game index, num_discard_cards, target_epsilon, beta).
+    """
+    parameters = list(it.product(range(number_of_games), num_discard_cards_grid))
+    manifest = RunManifest(
+        manifest_path,
+        {
+            "number_of_games": number_of_games,
+            "num_discard_cards_grid": num_discard_cards_grid,
+            "target_eps_grid": target_eps_grid,
+            "beta_grid": beta_grid,
+            "target_delta": target_delta,
+            "do_floor": do_floor,
+        },
+        seed,
+    )
+    with get_results_sink(
+        "psp_sweep", PSP_SWEEP_SCHEMA, do_floor, manifest.record
+    ) as psp_sweep_sink, SharedRankTable() as shared_rank_table, ProcessPoolExecutor(
+        max_workers=max_workers,
+        initializer=attach_shared_rank_table,
+        initargs=(shared_rank_table.handle,),
+    ) as executor:
+        psp_sweep_sink.recover(manifest)
+        futures = {}
+        for (game_index, num_discard_cards), game_seed_sequence in zip(
+            parameters, manifest.seed_sequence().spawn(len(parameters))
+        ):
+            units = {
+                (target_epsilon, beta): (
+                    game_index,
+                    num_discard_cards,
+                    target_epsilon,
+                    beta,
+                )
+                for target_epsilon, beta in it.product(target_eps_grid, beta_grid)
+            }
+            if all(unit in manifest for unit in units.values()):
+                continue
+            game_seed, psp_seed = game_seed_sequence.generate_state(2)
+            future = executor.submit(
+                run_psp_sweep_task,
+                int(game_seed),
+                int(psp_seed),
+                num_discard_cards,
+                target_eps_grid,
+                beta_grid,
+                target_delta,
+                do_floor,
+                game_stats_cache,
+            )
+            futures[future] = (num_discard_cards, units)
+
+        for future in as_completed(futures):
+            rows, seconds = future.result()
+            num_discard_cards, units = futures[future]
+            for key, unit in units.items():
+                # Rows of a game may have been written before an interruption.
+                if unit not in manifest:
+                    psp_sweep_sink.append(rows[key], unit)
+            print(
+                f"took {seconds : .2f} secs to run the sweep on a game with "
+                f"exp_num_discard_cards = {num_discard_cards}"
+            )
+
+
+def check_results_file(path, columns):
+    """
+    Creates a results file with the given columns if it does not exist. If it exists but misses some of the
+    columns, e.g., it was written before seeds were recorded, the missing columns are added, empty.
+    :param path: the path of the results file.
+    :param columns: the columns of the results file.
+    """
+    if not Path(path).is_file():
+        pd.DataFrame([], columns=columns).to_csv(path, index=False)
+    else:
+        results = pd.read_csv(path)
+        if list(results.columns) != columns:
+            results.reindex(columns=columns).to_csv(path, index=False)
 
 
 def check_if_results_file_exists(do_floor):
-    if not Path(f"results/games_do_floor_{do_floor}.csv").is_file():
-        pd.DataFrame(
-            [],
-            columns=[
-                "game_id",
-                "size_of_game",
-                "num_discard_cards",
-                "hand_p1",
-                "hand_p2",
-                "target_epsilon",
-                "target_delta",
-                "v_inf",
-                "v_1_inf",
-                "sample_complexity",
-                "simulation_complexity",
-            ],
-        ).to_csv(f"results/games_do_floor_{do_floor}.csv", index=False)
-
-    if not Path(f"results/psp_runs_do_floor_{do_floor}.csv").is_file():
-        pd.DataFrame(
-            [],
-            columns=[
-                "game_id",
-                "emp_sample_complexity",
-                "emp_simulation_complexity",
-            ],
-        ).to_csv(f"results/psp_runs_do_floor_{do_floor}.csv", index=False)
+    check_results_file(f"results/games_do_floor_{do_floor}.csv", GAMES_SCHEMA.names)
+    check_results_file(
+        f"results/psp_runs_do_floor_{do_floor}.csv", PSP_RUNS_SCHEMA.names
+    )
+    check_results_file(
+        f"results/psp_sweep_do_floor_{do_floor}.csv", PSP_SWEEP_SCHEMA.names
+    )
 
 
 if __name__ == "__main__":
@@ -126,29 +533,36 @@ if __name__ == "__main__":
     exp_beta = 1.1
     # beta = 1.05
 
+    # Sweep mode: run PSP for every target epsilon of exp_target_eps_grid and beta of exp_beta_grid on each game, on
+    # one shared stream of samples.
+    exp_sweep = False
+    exp_beta_grid = [1.1, 1.5, 2.0]
+
     check_if_results_file_exists(exp_do_floor)
 
-    for _, exp_num_discard_cards, exp_target_epsilon in it.product(
-        range(number_of_games), exp_num_discard_cards_grid, exp_target_eps_grid
-    ):
-        t0 = time.time()
-        random_game = generate_and_save_game(
-            num_discard_cards=exp_num_discard_cards,
-            target_epsilon=exp_target_epsilon,
+    # Units of work that are done are recorded in the manifest, so running this again resumes the experiment. Delete
+    # the manifest to run a new experiment.
+
+    if exp_sweep:
+        run_psp_sweep_in_parallel(
+            number_of_games=number_of_games,
+            num_discard_cards_grid=exp_num_discard_cards_grid,
+            target_eps_grid=exp_target_eps_grid,
+            beta_grid=exp_beta_grid,
             target_delta=exp_target_delta,
-            beta=exp_beta,
             do_floor=exp_do_floor,
+            manifest_path=f"results/manifest_psp_sweep_do_floor_{exp_do_floor}.jsonl",
+            game_stats_cache=GameStatsCache(),
         )
-        psp_run_and_save_stats(
-            game=random_game,
-            target_epsilon=exp_target_epsilon,
+    else:
+        run_experiments_in_parallel(
+            number_of_games=number_of_games,
+            num_discard_cards_grid=exp_num_discard_cards_grid,
+            target_eps_grid=exp_target_eps_grid,
             target_delta=exp_target_delta,
             number_psp_runs=exp_number_psp_runs,
             beta=exp_beta,
             do_floor=exp_do_floor,
-        )
-        print(
-            f"took {time.time() - t0 : .2f} secs to run game with parameters: "
-            f"exp_num_discard_cards = {exp_num_discard_cards}, "
-            f"exp_target_epsilon = {exp_target_epsilon}"
+            manifest_path=f"results/manifest_do_floor_{exp_do_floor}.jsonl",
+            game_stats_cache=GameStatsCache(),
         )
@@ -1,18 +1,71 @@
+import random
 import uuid
 
-import pandas as pd
+import numpy as np
+import pyarrow as pa
 
 from algorithms import psp
-from poker import sample_hands, get_deck, create_game
+from experiments import check_results_file
+from game_stats_cache import GameStatsCache
+from manifest import RunManifest
+from poker import sample_hands, get_deck, create_game, new_seed
+from results_sink import HAND_TYPE, ResultsSink
+from score_hands import cards_to_indices
 from stats import compute_game_stats, compute_v_inf, compute_v_1_inf
 
 
-def run_pair_expt(deck, target_eps, target_delta, beta, do_floor):
+PAIR_EXPERIMENT_SCHEMA = pa.schema(
+    [
+        ("target_epsilon", pa.float64()),
+        ("target_delta", pa.float64()),
+        ("beta", pa.float64()),
+        ("do_floor", pa.bool_()),
+        ("game_id", pa.string()),
+        ("size_of_game", pa.int64()),
+        ("num_discard_cards", pa.int64()),
+        ("hand_p1", HAND_TYPE),
+        ("hand_p2", HAND_TYPE),
+        ("v_inf", pa.float64()),
+        ("v_1_inf", pa.float64()),
+        ("emp_sample_complexity", pa.int64()),
+        ("emp_simulation_complexity", pa.int64()),
+        ("seed", pa.int64()),
+    ]
+)
+
+
+def run_pair_expt(
+    deck,
+    target_eps,
+    target_delta,
+    beta,
+    do_floor,
+    sink,
+    seed=None,
+    game_index=None,
+    manifest=(),
+    game_stats_cache=None,
+):
+    """
+    Draws a pair of hands and, for both 2 and 3 discarded cards, runs PSP and computes the game's stats.
+    :param seed: the seed from which the hands, the game id and the seeds of the two games are drawn. Each game gets
+    its own child seed, so their dealer cards are independent. If None, a fresh one.
+    :param game_index: the index of the pair in the experiment. If given, each row is appended with the key
+    (game_index, num_discard_cards, target_eps, 0) for the sink's on_flush.
+    :param manifest: the keys of rows that are done, e.g., a RunManifest, which are skipped.
+    :param game_stats_cache: a GameStatsCache, or None to always compute the games' stats.
+    """
+    if seed is None:
+        seed = new_seed()
     # For the same game, estimate num_discard_cards in [2, 3]
+    random.seed(seed)
     hand_p1, hand_p2 = sample_hands(deck)
-    game_id = str(uuid.uuid4())
-    results = []
-    for num_discard_cards in [2, 3]:
+    game_id = str(uuid.UUID(int=random.getrandbits(128), version=4))
+    game_seed_sequences = np.random.SeedSequence(seed).spawn(2)
+    for num_discard_cards, game_seed_sequence in zip([2, 3], game_seed_sequences):
+        unit = (game_index, num_discard_cards, target_eps, 0)
+        if unit in manifest:
+            continue
         game = create_game(
             {
                 "deck": [
@@ -24,16 +77,22 @@ def run_pair_expt(deck, target_eps, target_delta, beta, do_floor):
                 "hand_p1": hand_p1,
                 "hand_p2": hand_p2,
                 "bet_grid": ["*"],
+                "seed": int(game_seed_sequence.generate_state(1)[0]),
             }
         )
         # Run PSP
         psp_stats = psp(game, target_eps, target_delta, beta=beta, do_floor=do_floor)
 
-        # Compute the game's stats.
-        game_stats = compute_game_stats(game=game, do_floor=do_floor)
+        # Compute the game's stats, or read them from the cache.
+        if game_stats_cache is None:
+            game_stats = compute_game_stats(game=game, do_floor=do_floor)
+            v_inf = compute_v_inf(game_stats=game_stats)
+            v_1_inf = compute_v_1_inf(game_stats=game_stats)
+        else:
+            v_inf, v_1_inf = game_stats_cache.get_norms(game, do_floor)
 
         # Collect results
-        results.append(
+        sink.append(
             [
                 target_eps,
                 target_delta,
@@ -42,35 +101,16 @@ def run_pair_expt(deck, target_eps, target_delta, beta, do_floor):
                 game_id,
                 game["size_of_game"],
                 num_discard_cards,
-                hand_p1,
-                hand_p2,
-                compute_v_inf(game_stats=game_stats),
-                compute_v_1_inf(game_stats=game_stats),
+                cards_to_indices(hand_p1).tolist(),
+                cards_to_indices(hand_p2).tolist(),
+                v_inf,
+                v_1_inf,
                 psp_stats["emp_sample_complexity"],
                 psp_stats["emp_simulation_complexity"],
-            ]
+                seed,
+            ],
+            None if game_index is None else unit,
         )
-    results_df = pd.DataFrame(
-        results,
-        columns=[
-            "target_epsilon",
-            "target_delta",
-            "beta",
-            "do_floor",
-            "game_id",
-            "size_of_game",
-            "num_discard_cards",
-            "hand_p1",
-            "hand_p2",
-            "v_inf",
-            "v_1_inf",
-            "emp_sample_complexity",
-            "emp_simulation_complexity",
-        ],
-    )
-    results_df.to_csv(
-        f"results/pair_experiment.csv", mode="a", index=False, header=False
-    )
 
 
 if __name__ == "__main__":
@@ -85,12 +125,46 @@ if __name__ == "__main__":
     exp_do_floor = False
     number_of_games = 150
 
-    for i in range(0, number_of_games):
-        print(i)
-        run_pair_expt(
-            deck=expt_deck,
-            target_eps=exp_target_eps,
-            target_delta=exp_target_delta,
-            beta=exp_beta,
-            do_floor=exp_do_floor,
-        )
+    check_results_file("results/pair_experiment.csv", PAIR_EXPERIMENT_SCHEMA.names)
+
+    # Rows that are written are recorded in the manifest, so running this again resumes the experiment. Delete the
+    # manifest to run a new experiment.
+    pair_experiment_manifest = RunManifest(
+        "results/manifest_pair_experiment.jsonl",
+        {
+            "target_eps": exp_target_eps,
+            "target_delta": exp_target_delta,
+            "beta": exp_beta,
+            "do_floor": exp_do_floor,
+            "number_of_games": number_of_games,
+        },
+    )
+    pair_seed_sequences = pair_experiment_manifest.seed_sequence().spawn(
+        number_of_games
+    )
+
+    # Games' stats are cached on disk, and shared by reruns and by games that only differ by a permutation of suits.
+    pair_experiment_game_stats_cache = GameStatsCache()
+
+    with ResultsSink(
+        "results/pair_experiment",
+        PAIR_EXPERIMENT_SCHEMA,
+        csv_path="results/pair_experiment.csv",
+        batch_size=1,
+        on_flush=pair_experiment_manifest.record,
+    ) as pair_experiment_sink:
+        pair_experiment_sink.recover(pair_experiment_manifest)
+        for i in range(0, number_of_games):
+            print(i)
+            run_pair_expt(
+                deck=expt_deck,
+                target_eps=exp_target_eps,
+                target_delta=exp_target_delta,
+                beta=exp_beta,
+                do_floor=exp_do_floor,
+                sink=pair_experiment_sink,
+                seed=int(pair_seed_sequences[i].generate_state(1)[0]),
+                game_index=i,
+                manifest=pair_experiment_manifest,
+                game_stats_cache=pair_experiment_game_stats_cache,
+            )
@@ -0,0 +1,150 @@
+import fcntl
+import hashlib
+import json
+import os
+from contextlib import contextmanager
+from pathlib import Path
+
+from poker import to_canonical_profile
+from stats import compute_game_stats, compute_v_inf, compute_v_1_inf
+
+GAME_STATS_CACHE_PATH = "cache/game_stats"
+
+
+class GameStatsCache:
+    """
+    An on-disk cache of the exact statistics of games, see stats.compute_game_stats. Entries are keyed by the
+    canonical form of the game (see poker.Game.compute_canonical_form) and do_floor, so games that only differ by a
+    permutation of suits share an entry. Each entry is a JSON file with the mean and variance of each strategy
+    profile of the canonical game, and the game's v_inf and v_1_inf norms.
+    The cache can be shared by several processes: entries are written under a temporary name and renamed, a game is
+    computed by one process at a time, under a file lock, and the least recently used entries are evicted once the
+    cache exceeds max_bytes.
+    """
+
+    def __init__(self, path=GAME_STATS_CACHE_PATH, max_bytes=2 ** 28):
+        """
+        :param path: the directory of the cache.
+        :param max_bytes: the size of the entries above which the least recently used ones are evicted.
+        """
+        self.path = Path(path)
+        self.max_bytes = max_bytes
+        (self.path / "locks").mkdir(parents=True, exist_ok=True)
+
+    @contextmanager
+    def lock(self, name):
+        """
+        Holds an exclusive lock, shared by all processes using the cache.
+        :param name: the name of the lock.
+        """
+        with open(self.path / "locks" / f"{name}.lock", "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def get_entry(self, game, do_floor):
+        """
+        Reads the entry of a game, computing and writing it if it is not cached.
+        :param game: a poker game.
+        :param do_floor: floors card scores.
+        :return: the entry, a dictionary with the canonical profiles, their means and variances, v_inf and v_1_inf,
+        and the canonical positions of the cards of each player's hand.
+        """
+        canonical_key, canonical_positions = game.compute_canonical_form()
+        digest = hashlib.sha256(
+            json.dumps([canonical_key, do_floor]).encode()
+        ).hexdigest()
+        entry_path = self.path / f"{digest}.json"
+        # Lock stripes: games whose digests share a prefix are computed one at a time.
+        with self.lock(digest[:2]):
+            entry = self.read_entry(entry_path)
+            if entry is None:
+                entry = self.compute_entry(game, do_floor, canonical_positions)
+                self.write_entry(entry_path, entry)
+                self.evict()
+        entry["canonical_positions"] = canonical_positions
+        return entry
+
+    def get_game_stats(self, game, do_floor):
+        """
+        Cached version of stats.compute_game_stats.
+        :return: a map from the game's strategy profiles to their mean and variance.
+        """
+        entry = self.get_entry(game, do_floor)
+        canonical_game_stats = {
+            profile: {"mean": mean, "variance": variance}
+            for profile, mean, variance in zip(
+                entry["profiles"], entry["means"], entry["variances"]
+            )
+        }
+        p1_positions, p2_positions = entry["canonical_positions"]
+        return {
+            s: canonical_game_stats[to_canonical_profile(s, p1_positions, p2_positions)]
+            for s in game["strategy_profiles"]
+        }
+
+    def get_norms(self, game, do_floor):
+        """
+        :return: the v_inf and v_1_inf norms of the game, see stats.compute_v_inf and stats.compute_v_1_inf.
+        """
+        entry = self.get_entry(game, do_floor)
+        return entry["v_inf"], entry["v_1_inf"]
+
+    @staticmethod
+    def compute_entry(game, do_floor, canonical_positions):
+        game_stats = compute_game_stats(game=game, do_floor=do_floor)
+        return {
+            "profiles": [
+                to_canonical_profile(s, *canonical_positions) for s in game_stats
+            ],
+            "means": [stats["mean"] for stats in game_stats.values()],
+            "variances": [stats["variance"] for stats in game_stats.values()],
+            "v_inf": compute_v_inf(game_stats=game_stats),
+            "v_1_inf": compute_v_1_inf(game_stats=game_stats),
+        }
+
+    @staticmethod
+    def read_entry(entry_path):
+        try:
+            with open(entry_path) as entry_file:
+                entry = json.load(entry_file)
+            # Mark the entry as recently used.
+            os.utime(entry_path)
+        except FileNotFoundError:
+            return None
+        entry["profiles"] = [
+            (tuple(p1_index_discard), p1_bet, tuple(p2_index_discard), p2_bet)
+            for p1_index_discard, p1_bet, p2_index_discard, p2_bet in entry["profiles"]
+        ]
+        return entry
+
+    @staticmethod
+    def write_entry(entry_path, entry):
+        tmp_path = entry_path.with_name(f".{entry_path.name}.{os.getpid()}.tmp")
+        with open(tmp_path, "w") as entry_file:
+            json.dump(entry, entry_file)
+            entry_file.flush()
+            os.fsync(entry_file.fileno())
+        os.replace(tmp_path, entry_path)
+
+    def evict(self):
+        """
+        Deletes the least recently used entries until the cache is at most max_bytes.
+        """
+        with self.lock("evict"):
+            entries = []
+            for entry_path in self.path.glob("*.json"):
+                try:
+                    entries.append((entry_path.stat(), entry_path))
+                except FileNotFoundError:
+                    continue
+            size = sum(stat.st_size for stat, _ in entries)
+            for stat, entry_path in sorted(
+                entries, key=lambda entry: entry[0].st_mtime
+            ):
+                if size <= self.max_bytes:
+                    break
+                entry_path.unlink(missing_ok=True)
+                size -= stat.st_size
@@ -1,6 +1,20 @@
+import itertools
+import time
+from pathlib import Path
+
 import numpy as np
 import pandas as pd
-import itertools
+
+from score_hands import (
+    add_timing_hook,
+    build_rank_table,
+    hand_indices,
+    NUMBER_OF_CARDS,
+    NUMBER_OF_HANDS,
+    RANKS_CSV_PATH,
+    read_csv_scores,
+    save_rank_table,
+)
 
 
 def build_deck():
@@ -164,20 +178,124 @@ def score_hand(hand):
 
 def handvalues(combinations):
     scores = [
-        {"hand": i, "value": score_hand(i)} for i in combi
+        {"hand": i, "value": score_hand(i)} for i in combinations
     ]  # We iterate over all combinations scoring them
     scores = sorted(scores, key=lambda k: k["value"])  # We sort hands by score
     return scores
 
 
-deck = build_deck()  # We create our deck
-combi = combinations(
-    deck, 5
-)  # We create an array containing all possible 5 cards combinations
-hand_values = handvalues(combi)
-x = [i.get("hand", "") for i in hand_values]  # making a list of hands
-y = [i.get("value", "") for i in hand_values]  # making a list of values
+def write_csv(path="ranks.csv"):
+    """
+    Scores every hand one at a time with score_hand and writes the CSV read by score_hands.get_rank_table_from_csv.
+    This is slow; it is kept as the reference implementation of score_hands_vectorized.
+    :param path: where to write the CSV.
+    """
+    deck = build_deck()  # We create our deck
+    combi = combinations(
+        deck, 5
+    )  # We create an array containing all possible 5 cards combinations
+    hand_values = handvalues(combi)
+    x = [i.get("hand", "") for i in hand_values]  # making a list of hands
+    y = [i.get("value", "") for i in hand_values]  # making a list of values
+
+    data = {"hands": x, "value": y}  # making a dictionary of hands and values
+    df = pd.DataFrame(data)  # making a pandas dataframe with hands and values
+    df.to_csv(path, index=False)
+
+
+def all_hands():
+    """
+    Computes every 5-card hand as card indices (see score_hands.card_to_index), sorted within each hand.
+    :return: an integer array of shape (NUMBER_OF_HANDS, 5) whose i-th row is the hand with index i.
+    """
+    hands = combinations(np.arange(NUMBER_OF_CARDS), 5)
+    indexed_hands = np.empty_like(hands)
+    indexed_hands[hand_indices(hands)] = hands
+    return indexed_hands
+
+
+def score_hands_vectorized(hands):
+    """
+    Scores many hands at once. Gives exactly the same scores as score_hand, including its quirks, e.g., a royal
+    flush scores as a straight flush and a five-high straight flush scores as a flush.
+    :param hands: an integer array of shape (n, 5) with card indices, sorted within each hand.
+    :return: a float array of shape (n,) with the score of each hand.
+    """
+    numbers = hands // 4 + 2
+    letters = hands % 4
+    # rnum[i, j] counts the repetitions of the number of card j in hand i.
+    rnum = (numbers[:, :, None] == numbers[:, None, :]).sum(axis=2)
+    # Sort cards by repetitions and then by number, in decreasing order, e.g., 3 9 7 3 9 becomes 9 9 3 3 7.
+    n = np.take_along_axis(
+        numbers, np.argsort(-(16 * rnum + numbers), axis=1, kind="stable"), axis=1
+    )
+    n0, n1, n2, n3, n4 = n.T
+    max_number = numbers[:, 4]
+    is_flush = (letters == letters[:, :1]).all(axis=1)
+    is_distinct = rnum.max(axis=1) == 1
+    is_straight = is_distinct & (max_number - numbers[:, 0] == 4)
+    number_of_pairs = (rnum == 2).sum(axis=1) // 2
+    is_three = (rnum == 3).any(axis=1)
+    return np.select(
+        [
+            is_flush & is_straight,
+            is_flush,
+            (rnum == 4).any(axis=1),
+            is_three & (number_of_pairs == 1),
+            (numbers == [2, 3, 4, 5, 14]).all(axis=1),
+            is_three,
+            number_of_pairs == 2,
+            number_of_pairs == 1,
+            is_straight,
+        ],
+        [
+            120 + max_number,
+            75 + max_number / 100,
+            105 + n0 + n4 / 100,
+            90 + n0 + n3 / 100,
+            np.full(len(hands), 60),
+            45 + n0 + (n3 + n4) / 1000,
+            30 + n0 + n2 / 100 + n4 / 1000,
+            15 + n0 + n2 / 100 + n3 / 1000 + n4 / 10000,
+            55 + max_number,
+        ],
+        default=n0 + n1 / 100 + n2 / 1000 + n3 / 10000 + n4 / 100000,
+    ).astype(np.float64)
+
+
+def generate_rank_table(score=score_hands_vectorized, chunk_size=2 ** 18):
+    """
+    Scores every hand.
+    :param score: a function that scores an array of hands, e.g., score_hands_vectorized.
+    :param chunk_size: how many hands to score at once.
+    :return: a RankTable.
+    """
+    hands = all_hands()
+    scores = np.concatenate(
+        [score(hands[i : i + chunk_size]) for i in range(0, len(hands), chunk_size)]
+    )
+    return build_rank_table(np.arange(NUMBER_OF_HANDS), scores)
+
+
+def check_against_csv(csv_path=RANKS_CSV_PATH):
+    """
+    Cross-checks score_hands_vectorized against the CSV written by write_csv.
+    :param csv_path: the path to the zipped CSV.
+    :return: True if both give every hand exactly the same score.
+    """
+    csv_hand_indices, csv_scores = read_csv_scores(csv_path)
+    return np.array_equal(
+        score_hands_vectorized(all_hands()[csv_hand_indices]), csv_scores
+    )
+
 
-data = {"hands": x, "value": y}  # making a dictionary of hands and values
-df = pd.DataFrame(data)  # making a pandas dataframe with hands and values
-df.to_csv("ranks.csv", index=False)
+if __name__ == "__main__":
+    add_timing_hook(
+        lambda description, seconds: print(f"took {seconds} sec to {description}")
+    )
+    t0 = time.time()
+    generated_rank_table = generate_rank_table()
+    print(f"took {time.time() - t0} sec to score all hands")
+    save_rank_table(generated_rank_table)
+    if Path(RANKS_CSV_PATH).is_file():
+        print(f"matches {RANKS_CSV_PATH}: {check_against_csv()}")
@@ -0,0 +1,87 @@
+import json
+import os
+from pathlib import Path
+
+import numpy as np
+
+
+class RunManifest:
+    """
+    Records which units of work of a sweep are done, so that an interrupted sweep can be resumed by running it again.
+    A unit is a tuple, e.g., (game index, num_discard_cards, target_epsilon, replica). The manifest is a JSON lines
+    file: its first line holds the sweep's parameters and the entropy from which every seed of the sweep is derived,
+    and every other line holds one unit. Lines are fsync-ed as they are appended, and a partial last line, left by a
+    crash, is discarded when the manifest is loaded.
+    """
+
+    def __init__(self, path, parameters, seed=None):
+        """
+        Loads the manifest at path, or creates it.
+        :param path: the manifest file. If None, nothing is persisted.
+        :param parameters: a dictionary with the parameters of the sweep, which must match those of the manifest.
+        :param seed: the entropy of the sweep, which must match that of the manifest. If None, the manifest's, or fresh
+        entropy for a new manifest.
+        """
+        self.path = None if path is None else Path(path)
+        self.parameters = json.loads(json.dumps(parameters))
+        self.done = set()
+        if self.path is not None and self.path.is_file():
+            header = self.load()
+            if header["parameters"] != self.parameters:
+                raise ValueError(
+                    f"{self.path} records a sweep with parameters {header['parameters']}, not "
+                    f"{self.parameters}; delete it to start a new sweep"
+                )
+            if seed is not None and seed != header["entropy"]:
+                raise ValueError(
+                    f"{self.path} records a sweep with seed {header['entropy']}, not {seed}"
+                )
+            self.entropy = header["entropy"]
+        else:
+            self.entropy = np.random.SeedSequence(seed).entropy
+            self.write_lines([{"parameters": self.parameters, "entropy": self.entropy}])
+
+    def load(self):
+        """
+        Reads the units that are done, and truncates a partial last line.
+        :return: the header of the manifest.
+        """
+        with open(self.path, "rb+") as manifest_file:
+            content = manifest_file.read()
+            complete_length = content.rfind(b"\n") + 1
+            if complete_length < len(content):
+                manifest_file.truncate(complete_length)
+        header, *units = [
+            json.loads(line) for line in content[:complete_length].splitlines()
+        ]
+        self.done = {tuple(unit) for unit in units}
+        return header
+
+    def seed_sequence(self):
+        """
+        :return: the numpy SeedSequence from which the seeds of the sweep are derived.
+        """
+        return np.random.SeedSequence(self.entropy)
+
+    def record(self, units):
+        """
+        Records that some units are done.
+        :param units: a list of tuples.
+        """
+        units = [tuple(unit) for unit in units]
+        self.write_lines(units)
+        self.done.update(units)
+
+    def write_lines(self, records):
+        if self.path is None or len(records) == 0:
+            return
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.path, "a") as manifest_file:
+            manifest_file.write(
+                "".join(json.dumps(record) + "\n" for record in records)
+            )
+            manifest_file.flush()
+            os.fsync(manifest_file.fileno())
+
+    def __contains__(self, unit):
+        return tuple(unit) in self.done
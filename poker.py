@@ -1,69 +1,451 @@
 import itertools as it
 import random
+from collections.abc import Mapping
 
-from score_hands import append_cards, left_hand_points
-from math import comb
+import numpy as np
+
+from score_hands import (
+    append_cards,
+    canonical_suits,
+    cards_to_indices,
+    get_completed_hands_ordinals,
+    index_to_card,
+    left_hand_points,
+    permute_suits,
+)
+
+
+class StrategyProfiles(Mapping):
+    """
+    A read-only map from the strategy profiles of a game to the players' kept hands, as follows:
+        {(p1_index_discard, p1_bet, p2_index_discard, p2_bet) :
+            {'p1': {'hand': p1_kept_hand},
+            'p2': {'hand': p2_kept_hand}}
+        }
+    Profiles are enumerated lazily and their values are built on access, from the game's kept hands.
+    """
+
+    __slots__ = ("game",)
+
+    def __init__(self, game):
+        self.game = game
+
+    def __iter__(self):
+        return it.product(
+            self.game.index_discards,
+            self.game.bet_grid,
+            self.game.index_discards,
+            self.game.bet_grid,
+        )
+
+    def __len__(self):
+        return len(self.game.index_discards) ** 2 * len(self.game.bet_grid) ** 2
+
+    def __getitem__(self, strategy_profile):
+        try:
+            p1_index_discard, p1_bet, p2_index_discard, p2_bet = strategy_profile
+            if p1_bet not in self.game.bet_grid or p2_bet not in self.game.bet_grid:
+                raise KeyError(strategy_profile)
+            return {
+                "p1": {"hand": self.game.get_kept_cards("p1", p1_index_discard)},
+                "p2": {"hand": self.game.get_kept_cards("p2", p2_index_discard)},
+            }
+        except (TypeError, ValueError):
+            raise KeyError(strategy_profile)
+
+
+class Game:
+    """
+    A poker game. For each player, the hands kept after each discard choice are stored as rows of an integer array
+    of card indices (see score_hands.card_to_index). For existing callers, game[key] reads the attribute key, e.g.,
+    game["strategy_profiles"], as if the game were the dictionary create_game used to return.
+    """
+
+    __slots__ = (
+        "id",
+        "seed",
+        "rng",
+        "deck",
+        "num_discard_cards",
+        "hand_p1",
+        "hand_p2",
+        "bet_grid",
+        "index_discards",
+        "index_discard_positions",
+        "kept_hands_p1",
+        "kept_hands_p2",
+        "representative_pair_ids",
+        "determined_payoffs",
+    )
+
+    def __init__(self, deck, num_discard_cards, hand_p1, hand_p2, bet_grid, seed):
+        # id is supposed to "uniquely" identify a game
+        self.id = random.randint(10000000, 99999999)
+        # The game's random number generator draws dealer cards, see draw_dealer_cards.
+        self.seed = seed
+        self.rng = np.random.default_rng(seed)
+        self.deck = deck
+        self.num_discard_cards = num_discard_cards
+        self.hand_p1 = hand_p1
+        self.hand_p2 = hand_p2
+        self.bet_grid = bet_grid
+        # Discard choices, as tuples of positions of the discarded cards in a hand.
+        self.index_discards = list(it.combinations(range(5), num_discard_cards))
+        self.index_discard_positions = {
+            index_discard: position
+            for position, index_discard in enumerate(self.index_discards)
+        }
+        # kept_hands_p[position] is the hand kept after discard choice index_discards[position].
+        self.kept_hands_p1 = self.compute_kept_hands(hand_p1)
+        self.kept_hands_p2 = self.compute_kept_hands(hand_p2)
+        # Computed on first use, see get_representative_pair_id and get_determined_payoffs.
+        self.representative_pair_ids = None
+        self.determined_payoffs = {}
+
+    def compute_kept_hands(self, hand):
+        hand_indices = cards_to_indices(hand)
+        return np.array(
+            [
+                np.delete(hand_indices, index_discard)
+                for index_discard in self.index_discards
+            ],
+            dtype=np.int64,
+        ).reshape(len(self.index_discards), 5 - self.num_discard_cards)
+
+    def compute_representative_pair_ids(self):
+        """
+        Groups the pairs of discard choices of both players into classes with the same distribution of payoffs. The
+        payoff of a strategy profile only depends on the players' discard choices, not on their bets, and hand scores
+        do not depend on which suit is which. So if a permutation of suits maps the deck onto itself, and the hands
+        kept by both players after some pair of discard choices onto the hands they keep after another, the two pairs
+        have the same payoff for every draw of dealer cards, up to that permutation, which preserves draws' uniform
+        distribution.
+        A pair of discard choices at positions (i, j) of index_discards is identified by i * len(index_discards) + j.
+        :return: an integer array mapping the id of each pair to the smallest id of its class, its representative.
+        """
+        num_index_discards = len(self.index_discards)
+        deck = cards_to_indices(self.deck)
+        representative_pair_ids = np.arange(num_index_discards ** 2)
+        for suit_permutation in it.permutations(range(4)):
+            suit_permutation = np.array(suit_permutation)
+
+            def permute(cards):
+                return cards - cards % 4 + suit_permutation[cards % 4]
+
+            if set(permute(deck).tolist()) != set(deck.tolist()):
+                continue
+            # The position of the kept hand each kept hand is mapped onto, or -1 if it is not a kept hand.
+            p1_positions = permute_kept_hands(self.kept_hands_p1, permute)
+            p2_positions = permute_kept_hands(self.kept_hands_p2, permute)
+            is_mapped = (p1_positions[:, None] >= 0) & (p2_positions[None, :] >= 0)
+            pair_ids = (
+                p1_positions[:, None] * num_index_discards + p2_positions[None, :]
+            )
+            representative_pair_ids = np.where(
+                is_mapped.ravel(),
+                np.minimum(representative_pair_ids, pair_ids.ravel()),
+                representative_pair_ids,
+            )
+        return representative_pair_ids
+
+    def compute_canonical_form(self):
+        """
+        Relabels suits so that games that only differ by a permutation of suits, and thus have the same statistics up
+        to the relabeling of positions in the hands, get the same canonical form (see score_hands.canonical_suits).
+        :return: the canonical key of the game, a tuple (num_discard_cards, bet_grid, hand_p1, hand_p2, deck) where
+        hands and the deck are sorted tuples of card indices, and, for each player, the canonical position of the
+        card at each position of the player's hand.
+        """
+        hands = [
+            cards_to_indices(cards)[None]
+            for cards in [self.hand_p1, self.hand_p2, self.deck]
+        ]
+        permutation = canonical_suits(*hands)
+        canonical_hands = [permute_suits(hand, permutation)[0] for hand in hands]
+        # Relabel each card of the hands in place, without sorting, to find where it lands in the canonical hand.
+        canonical_positions = [
+            np.searchsorted(
+                canonical_hand, hand[0] - hand[0] % 4 + permutation[0][hand[0] % 4]
+            )
+            for hand, canonical_hand in zip(hands[:2], canonical_hands)
+        ]
+        key = (
+            self.num_discard_cards,
+            tuple(self.bet_grid),
+            *(tuple(canonical_hand.tolist()) for canonical_hand in canonical_hands),
+        )
+        return key, canonical_positions
+
+    def canonical_key(self):
+        """
+        :return: a hashable key shared by all games that only differ by a permutation of suits, e.g., to cache
+        statistics of games, see compute_canonical_form.
+        """
+        return self.compute_canonical_form()[0]
+
+    def canonical_strategy_profile(self, strategy_profile):
+        """
+        :param strategy_profile: a strategy profile.
+        :return: the strategy profile of the game in canonical form, see compute_canonical_form, that has the same
+        statistics.
+        """
+        return to_canonical_profile(strategy_profile, *self.compute_canonical_form()[1])
+
+    def get_representative_pair_id(self, strategy_profile):
+        """
+        :param strategy_profile: a strategy profile.
+        :return: the id of the representative pair of discard choices of the strategy profile, see
+        compute_representative_pair_ids.
+        """
+        if self.representative_pair_ids is None:
+            self.representative_pair_ids = self.compute_representative_pair_ids()
+        p1_index_discard, _, p2_index_discard, _ = strategy_profile
+        return int(
+            self.representative_pair_ids[
+                self.index_discard_positions[p1_index_discard]
+                * len(self.index_discards)
+                + self.index_discard_positions[p2_index_discard]
+            ]
+        )
+
+    def compute_ordinal_ranges(self, do_floor, chunk_size=2 ** 16):
+        """
+        For each discard choice of each player, computes the lowest and highest ordinals of the completed hands over
+        every draw of dealer cards, i.e., the worst and best hands the kept hand can reach.
+        :param do_floor: floors card scores.
+        :param chunk_size: the maximum number of draws of dealer cards processed at once.
+        :return: a map from "p1" and "p2" to integer arrays of shape (len(index_discards), 2), with the lowest and
+        highest ordinals after each discard choice.
+        """
+        ordinal_ranges = {
+            player: np.array(
+                [[np.iinfo(np.int64).max, np.iinfo(np.int64).min]]
+                * len(self.index_discards)
+            )
+            for player in ["p1", "p2"]
+        }
+        for dealer_cards in iter_all_dealer_cards(self, chunk_size):
+            for player, ranges in ordinal_ranges.items():
+                ordinals = score_kept_hands(
+                    self, player, self.index_discards, dealer_cards, do_floor
+                )
+                for position, index_discard in enumerate(self.index_discards):
+                    ranges[position, 0] = min(
+                        ranges[position, 0], ordinals[index_discard].min()
+                    )
+                    ranges[position, 1] = max(
+                        ranges[position, 1], ordinals[index_discard].max()
+                    )
+        return ordinal_ranges
+
+    def compute_determined_payoffs(self, do_floor):
+        """
+        Finds the strategy profiles whose payoff is the same for every draw of dealer cards: those where the worst hand
+        one player can reach beats the best hand the other can reach, or where both players always reach hands of the
+        same ordinal.
+        :param do_floor: floors card scores.
+        :return: an array indexed like the strategy profiles, with player 1's payoff in determined profiles, and NaN
+        in the others.
+        """
+        ordinal_ranges = self.compute_ordinal_ranges(do_floor)
+        p1_lowest = ordinal_ranges["p1"][:, None, 0]
+        p1_highest = ordinal_ranges["p1"][:, None, 1]
+        p2_lowest = ordinal_ranges["p2"][None, :, 0]
+        p2_highest = ordinal_ranges["p2"][None, :, 1]
+        num_index_discards = len(self.index_discards)
+        payoffs = np.full((num_index_discards, num_index_discards), np.nan)
+        payoffs[p1_lowest > p2_highest] = 1.0
+        payoffs[p1_highest < p2_lowest] = -1.0
+        payoffs[
+            (p1_lowest == p1_highest)
+            & (p2_lowest == p2_highest)
+            & (p1_lowest == p2_lowest)
+        ] = 0.0
+        # Strategy profiles enumerate discard choices and bets of player 1, then of player 2, and bets do not change
+        # payoffs.
+        num_bets = len(self.bet_grid)
+        return np.broadcast_to(
+            payoffs[:, None, :, None],
+            (num_index_discards, num_bets, num_index_discards, num_bets),
+        ).ravel()
+
+    def get_determined_payoffs(self, do_floor):
+        """
+        Cached version of compute_determined_payoffs.
+        """
+        if do_floor not in self.determined_payoffs:
+            self.determined_payoffs[do_floor] = self.compute_determined_payoffs(
+                do_floor
+            )
+        return self.determined_payoffs[do_floor]
+
+    def get_index_discards(self, pair_id):
+        """
+        :param pair_id: the id of a pair of discard choices, see compute_representative_pair_ids.
+        :return: the discard choices of player 1 and player 2.
+        """
+        p1_position, p2_position = divmod(pair_id, len(self.index_discards))
+        return self.index_discards[p1_position], self.index_discards[p2_position]
+
+    @property
+    def size_of_game(self):
+        return len(self.strategy_profiles)
+
+    @property
+    def strategy_profiles(self):
+        return StrategyProfiles(self)
+
+    def get_kept_hand(self, player, index_discard):
+        """
+        :param player: either "p1" or "p2".
+        :param index_discard: a tuple with the positions of the discarded cards in the player's hand.
+        :return: an integer array with the card indices of the hand the player keeps.
+        """
+        kept_hands = self.kept_hands_p1 if player == "p1" else self.kept_hands_p2
+        return kept_hands[self.index_discard_positions[index_discard]]
+
+    def get_kept_cards(self, player, index_discard):
+        """
+        :param player: either "p1" or "p2".
+        :param index_discard: a tuple with the positions of the discarded cards in the player's hand.
+        :return: a list with the cards the player keeps.
+        """
+        return [
+            index_to_card(card) for card in self.get_kept_hand(player, index_discard)
+        ]
+
+    def __repr__(self):
+        return (
+            f"Game(id={self.id}, hand_p1={self.hand_p1}, hand_p2={self.hand_p2}, "
+            f"num_discard_cards={self.num_discard_cards}, bet_grid={self.bet_grid})"
+        )
+
+    def __getitem__(self, key):
+        if key not in self.__slots__ + ("size_of_game", "strategy_profiles"):
+            raise KeyError(key)
+        return getattr(self, key)
+
+
+def to_canonical_profile(strategy_profile, p1_positions, p2_positions):
+    """
+    :param strategy_profile: a strategy profile.
+    :param p1_positions: the canonical position of the card at each position of player 1's hand.
+    :param p2_positions: the canonical position of the card at each position of player 2's hand.
+    :return: the strategy profile with the discarded positions mapped to canonical positions.
+    """
+    p1_index_discard, p1_bet, p2_index_discard, p2_bet = strategy_profile
+    return (
+        tuple(sorted(int(p1_positions[i]) for i in p1_index_discard)),
+        p1_bet,
+        tuple(sorted(int(p2_positions[i]) for i in p2_index_discard)),
+        p2_bet,
+    )
+
+
+def permute_kept_hands(kept_hands, permute):
+    """
+    :param kept_hands: an integer array whose rows are hands, as card indices.
+    :param permute: a function that maps an array of card indices to another.
+    :return: an integer array with the row onto which permute maps each row, as a set of cards, or -1 if none.
+    """
+    positions = {
+        frozenset(kept_hand.tolist()): position
+        for position, kept_hand in enumerate(kept_hands)
+    }
+    return np.array(
+        [
+            positions.get(frozenset(permute(kept_hand).tolist()), -1)
+            for kept_hand in kept_hands
+        ]
+    )
 
 
 def create_game(game_parameters):
     """
-    Given game parameters, returns a dictionary that specifies a game.
+    Given game parameters, returns a Game.
     :param game_parameters: a dictionary with the following data:
             "deck": a list of cars,
             "num_discard_cards": an integer indicating how many cars players are required to discard,
             "hand_p1": a list of cards,
             "hand_p2": a list of cards,
-            "bet_grid": a list of two integers, each integer denoting the bet of each player.
-    :return: a dictionary.
+            "bet_grid": a list of two integers, each integer denoting the bet of each player,
+            "seed" (optional): the seed of the game's random number generator, a fresh one by default.
+    :return: a Game.
     """
-    return {
-        # id is supposed to "uniquely" identify a game
-        "id": random.randint(10000000, 99999999),
-        "deck": game_parameters["deck"],
-        "num_discard_cards": game_parameters["num_discard_cards"],
-        "hand_p1": game_parameters["hand_p1"],
-        "hand_p2": game_parameters["hand_p2"],
-        "size_of_game": comb(5, game_parameters["num_discard_cards"])
-        * comb(5, game_parameters["num_discard_cards"])
-        * len(game_parameters["bet_grid"])
-        * len(game_parameters["bet_grid"]),
-        "strategy_profiles": {
-            (p1_index_discard, p1_bet, p2_index_discard, p2_bet): {
-                "p1": {
-                    "hand": [
-                        c
-                        for i, c in enumerate(game_parameters["hand_p1"])
-                        if i not in p1_index_discard
-                    ],
-                    "estimates": (0.0, 0.0),
-                },
-                "p2": {
-                    "hand": [
-                        c
-                        for i, c in enumerate(game_parameters["hand_p2"])
-                        if i not in p2_index_discard
-                    ],
-                    "estimates": (0.0, 0.0),
-                },
-            }
-            for p1_index_discard, p1_bet, p2_index_discard, p2_bet in it.product(
-                it.combinations(range(5), game_parameters["num_discard_cards"]),
-                game_parameters["bet_grid"],
-                it.combinations(range(5), game_parameters["num_discard_cards"]),
-                game_parameters["bet_grid"],
-            )
-        },
-    }
+    seed = game_parameters.get("seed")
+    if seed is None:
+        seed = new_seed()
+    return Game(
+        deck=game_parameters["deck"],
+        num_discard_cards=game_parameters["num_discard_cards"],
+        hand_p1=game_parameters["hand_p1"],
+        hand_p2=game_parameters["hand_p2"],
+        bet_grid=game_parameters["bet_grid"],
+        seed=seed,
+    )
+
+
+def new_seed():
+    """
+    Draws a fresh seed for a random number generator from the OS entropy.
+    :return: an integer.
+    """
+    return int(np.random.SeedSequence().generate_state(1)[0])
 
 
-def draw_randomness(game, m):
+def draw_dealer_cards(game, m, rng=None):
+    """
+    Draws m samples of dealer cards at once, each sample without replacement from the game's deck.
+    :param game: a poker game.
+    :param m: how many samples.
+    :param rng: a numpy random Generator. By default, the game's.
+    :return: an integer array of shape (m, num_discard_cards) with card indices (see score_hands.card_to_index).
+    """
+    rng = game["rng"] if rng is None else rng
+    deck = cards_to_indices(game["deck"])
+    positions = np.empty((m, 0), dtype=np.int64)
+    for j in range(game["num_discard_cards"]):
+        # Draw a position among the len(deck) - j positions not drawn yet, then skip the positions already drawn.
+        position = rng.integers(len(deck) - j, size=m)
+        for drawn_position in np.sort(positions, axis=1).T:
+            position += position >= drawn_position
+        positions = np.column_stack([positions, position])
+    return deck[positions]
+
+
+def draw_randomness(game, m, rng=None):
     """
     Draw a list with m random cards.
     :param game: a poker game.
     :param m: how many samples.
+    :param rng: a numpy random Generator. By default, the game's.
     :return: list of cards.
     """
-    return [random.sample(game["deck"], game["num_discard_cards"]) for _ in range(m)]
+    return [
+        [index_to_card(card) for card in dealer_cards]
+        for dealer_cards in draw_dealer_cards(game, m, rng)
+    ]
+
+
+def iter_all_dealer_cards(game, chunk_size=2 ** 16):
+    """
+    Streams every possible draw of dealer cards in chunks, so that memory stays bounded.
+    :param game: a poker game.
+    :param chunk_size: the maximum number of draws per chunk.
+    :return: a generator of integer arrays of shape (at most chunk_size, num_discard_cards) with card indices.
+    """
+    num_discard_cards = game["num_discard_cards"]
+    all_dealer_cards = it.combinations(
+        cards_to_indices(game["deck"]).tolist(), num_discard_cards
+    )
+    while True:
+        dealer_cards = np.fromiter(
+            it.chain.from_iterable(it.islice(all_dealer_cards, chunk_size)),
+            dtype=np.int64,
+        ).reshape(-1, num_discard_cards)
+        if len(dealer_cards) == 0:
+            return
+        yield dealer_cards
 
 
 def simulate_game(strategy_profile, game, list_of_dealer_cards, do_floor):
@@ -91,6 +473,69 @@ def simulate_game(strategy_profile, game, list_of_dealer_cards, do_floor):
     return total_sum_p1_points, total_sum_p1_points_squared
 
 
+def get_kept_hand(game, player, index_discard):
+    """
+    Computes the hand a player keeps after discarding some cards.
+    :param game: a poker game.
+    :param player: either "p1" or "p2".
+    :param index_discard: a tuple with the positions of the discarded cards in the player's hand.
+    :return: an integer array with the card indices of the kept hand.
+    """
+    return game.get_kept_hand(player, index_discard)
+
+
+def score_kept_hands(game, player, index_discards, dealer_cards, do_floor):
+    """
+    For each given discard choice of a player, completes the kept hand with each draw of dealer cards and scores it.
+    :param game: a poker game.
+    :param player: either "p1" or "p2".
+    :param index_discards: an iterable of discard choices, each a tuple of positions in the player's hand.
+    :param dealer_cards: an integer array of shape (m, num_discard_cards) with card indices, one draw per row.
+    :param do_floor: floors card scores.
+    :return: a map from discard choices to integer arrays of shape (m,) with the ordinals of the completed hands.
+    """
+    return {
+        index_discard: get_completed_hands_ordinals(
+            get_kept_hand(game, player, index_discard), dealer_cards, do_floor
+        )
+        for index_discard in index_discards
+    }
+
+
+def simulate_game_from_ordinals(p1_ordinals, p2_ordinals):
+    """
+    Scores a strategy profile given the ordinals of both players' completed hands for each draw of dealer cards.
+    :param p1_ordinals: an integer array with the ordinals of player 1's completed hands.
+    :param p2_ordinals: an integer array with the ordinals of player 2's completed hands.
+    :return: sum of scores and sum of scores squared.
+    """
+    p1_points = np.sign(p1_ordinals - p2_ordinals)
+    # Points are -1, 0 or 1, so the sum of squares counts the non-zero points.
+    return int(p1_points.sum()), int(np.count_nonzero(p1_points))
+
+
+def simulate_game_batch(strategy_profile, game, dealer_cards, do_floor):
+    """
+    Batched version of simulate_game: scores both players' completed hands for all draws of dealer cards at once.
+    The per-sample simulate_game is kept as a reference implementation.
+    :param strategy_profile: a strategy profile.
+    :param game: a poker game.
+    :param dealer_cards: an integer array of shape (m, num_discard_cards) with card indices (see
+    score_hands.card_to_index), one draw of dealer cards per row.
+    :param do_floor: floors card scores.
+    :return: sum of scores and sum of scores squared.
+    """
+    p1_index_discard, _, p2_index_discard, _ = strategy_profile
+    return simulate_game_from_ordinals(
+        score_kept_hands(game, "p1", [p1_index_discard], dealer_cards, do_floor)[
+            p1_index_discard
+        ],
+        score_kept_hands(game, "p2", [p2_index_discard], dealer_cards, do_floor)[
+            p2_index_discard
+        ],
+    )
+
+
 def sample_hands(deck):
     """
     Given a deck, that is, a list of cards, return a random pair of hands.
@@ -112,11 +557,12 @@ def get_deck():
     ]
 
 
-def sample_game(num_discard_cards, bet_grid=["*"]):
+def sample_game(num_discard_cards, bet_grid=["*"], seed=None):
     """
     Samples a random game.
     :param num_discard_cards: an integer encoding how many cards each player must discard.
     :param bet_grid: a list of two integers, each encoding the best of each player.
+    :param seed: the seed of the game's random number generator, a fresh one by default.
     :return: a poker game.
     """
     deck = get_deck()
@@ -131,5 +577,6 @@ def sample_game(num_discard_cards, bet_grid=["*"]):
             "hand_p1": hand_p1,
             "hand_p2": hand_p2,
             "bet_grid": bet_grid,
+            "seed": seed,
         }
     )
@@ -0,0 +1,162 @@
+import json
+import os
+import time
+from pathlib import Path
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from score_hands import index_to_card
+
+# Type of the columns that hold hands, stored as arrays of card indices (see score_hands.card_to_index).
+HAND_TYPE = pa.list_(pa.int8())
+
+
+class ResultsSink:
+    """
+    Buffers rows of results and flushes them in batches. Each batch is written as one Parquet file in a directory,
+    with typed columns, and, optionally, appended to a CSV file in the format of the CSVs in results/, where hands
+    are lists of cards. A sink is meant to be owned by a single writer process, e.g., the process collecting the
+    rows computed by a pool of workers. Batch files are fsync-ed under a temporary name and then renamed, so readers
+    never see a partial batch. Each batch file also holds the keys of its rows, so that a writer interrupted after
+    writing a batch but before on_flush can recover it, see recover.
+    """
+
+    def __init__(self, path, schema, csv_path=None, batch_size=64, on_flush=None):
+        """
+        :param path: the directory where batches are written.
+        :param schema: a pyarrow schema with the columns of the rows.
+        :param csv_path: a CSV file to which batches are also appended, or None.
+        :param batch_size: how many rows to buffer before flushing. Rows still buffered are lost if the writer is
+        killed, so sinks whose rows take long to compute should flush every row.
+        :param on_flush: a function called with the keys of the rows of each batch once the batch is written, e.g.,
+        RunManifest.record.
+        """
+        self.path = Path(path)
+        self.schema = schema
+        self.csv_path = csv_path
+        self.batch_size = batch_size
+        self.on_flush = on_flush
+        self.rows = []
+        self.keys = []
+        self.path.mkdir(parents=True, exist_ok=True)
+
+    def append(self, row, key=None):
+        """
+        Buffers a row, and flushes if the buffer is full.
+        :param row: a list of values, in the order of the schema's columns.
+        :param key: identifies the row for on_flush, or None.
+        """
+        self.rows.append(row)
+        if key is not None:
+            self.keys.append(key)
+        if len(self.rows) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Writes the buffered rows.
+        """
+        if len(self.rows) == 0:
+            return
+        table = pa.Table.from_pydict(
+            {
+                name: [row[i] for row in self.rows]
+                for i, name in enumerate(self.schema.names)
+            },
+            schema=self.schema,
+        )
+        # The size of the CSV before the batch is appended, so that recover can append it again.
+        csv_size = None
+        if self.csv_path is not None:
+            csv_size = (
+                os.path.getsize(self.csv_path) if os.path.isfile(self.csv_path) else 0
+            )
+        table = table.replace_schema_metadata(
+            {"keys": json.dumps(self.keys), "csv_size": json.dumps(csv_size)}
+        )
+        batch_name = f"part-{time.time_ns()}.parquet"
+        tmp_path = self.path / f".{batch_name}.tmp"
+        with open(tmp_path, "wb") as batch_file:
+            pq.write_table(table, batch_file)
+            batch_file.flush()
+            os.fsync(batch_file.fileno())
+        os.replace(tmp_path, self.path / batch_name)
+        if self.csv_path is not None:
+            append_csv(table, self.csv_path)
+        if self.on_flush is not None:
+            self.on_flush(self.keys)
+        self.rows = []
+        self.keys = []
+
+    def recover(self, done):
+        """
+        Passes to on_flush the keys of the last batch written that are not done, i.e., when the writer was interrupted
+        after writing the batch but before on_flush returned, so that their rows are not computed and written again.
+        The CSV is then truncated to its size before the batch, and the batch is appended to it again. Batches before
+        the last one were passed to on_flush before it was written.
+        :param done: the keys passed to on_flush so far, e.g., a RunManifest.
+        """
+        batch_paths = sorted(self.path.glob("part-*.parquet"))
+        if len(batch_paths) == 0:
+            return
+        metadata = pq.read_schema(batch_paths[-1]).metadata or {}
+        keys = [tuple(key) for key in json.loads(metadata.get(b"keys", b"[]"))]
+        missing_keys = [key for key in keys if key not in done]
+        if len(missing_keys) == 0:
+            return
+        csv_size = json.loads(metadata.get(b"csv_size", b"null"))
+        if self.csv_path is not None and csv_size is not None:
+            if os.path.isfile(self.csv_path):
+                with open(self.csv_path, "r+") as csv_file:
+                    csv_file.truncate(csv_size)
+            append_csv(
+                pq.read_table(batch_paths[-1], schema=self.schema), self.csv_path
+            )
+        if self.on_flush is not None:
+            self.on_flush(missing_keys)
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def read_results(path, schema):
+    """
+    Reads every batch written by a ResultsSink.
+    :param path: the directory where batches are written.
+    :param schema: the pyarrow schema of the rows.
+    :return: a pandas DataFrame.
+    """
+    batch_paths = sorted(Path(path).glob("part-*.parquet"))
+    if len(batch_paths) == 0:
+        return schema.empty_table().to_pandas()
+    return pa.concat_tables(
+        [pq.read_table(batch_path, schema=schema) for batch_path in batch_paths]
+    ).to_pandas()
+
+
+def append_csv(table, csv_path):
+    """
+    Appends a table to a CSV file, writing hands as lists of cards. Writes the header if the file does not exist.
+    :param table: a pyarrow table.
+    :param csv_path: the CSV file.
+    """
+    results = table.to_pandas()
+    for field in table.schema:
+        if field.type == HAND_TYPE:
+            results[field.name] = [
+                str([index_to_card(card) for card in hand])
+                for hand in results[field.name]
+            ]
+    results.to_csv(
+        csv_path,
+        mode="a",
+        index=False,
+        header=not os.path.isfile(csv_path) or os.path.getsize(csv_path) == 0,
+    )
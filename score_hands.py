@@ -1,45 +1,503 @@
+import fcntl
 import functools
 import math
+import os
 import time
+import uuid
+from contextlib import contextmanager
+from multiprocessing import shared_memory
+from pathlib import Path
 
+import numpy as np
 import pandas as pd
 
+SUIT_TO_NUMBER = {"H": 0, "S": 1, "C": 2, "D": 3}
+NUMBER_OF_CARDS = 52
+NUMBER_OF_HANDS = math.comb(NUMBER_OF_CARDS, 5)
 
-def get_scores_dict():
+# The rank table is stored as two .npy files: RANKS_PATH holds a (2, NUMBER_OF_HANDS) uint16 array with the
+# ordinals and floor ordinals of each hand, and RANK_VALUES_PATH holds the sorted distinct scores.
+RANKS_PATH = "ranks.npy"
+RANK_VALUES_PATH = "ranks_values.npy"
+RANKS_CSV_PATH = "ranks.zip"
+# The rank table in canonical form, see save_canonical_rank_table.
+RANKS_CANONICAL_PATH = "ranks_canonical.npz"
+
+# BINOMIALS[n][k] = n choose k, used to rank hands in the combinatorial number system.
+BINOMIALS = [[math.comb(n, k) for k in range(6)] for n in range(NUMBER_OF_CARDS + 1)]
+BINOMIALS_ARRAY = np.array(BINOMIALS, dtype=np.int64)
+
+
+def card_to_index(card, suit_to_number=SUIT_TO_NUMBER):
+    """
+    Maps a card to an integer in [0, 52). The map is consistent with compare_cards, i.e., x is smaller than y
+    according to compare_cards if and only if card_to_index(x) < card_to_index(y).
+    :param card: a card, e.g., "H14".
+    :param suit_to_number: a map from suits to integers.
+    :return: the index of the card.
+    """
+    return 4 * (int(card[1:]) - 2) + suit_to_number[card[0]]
+
+
+def index_to_card(index, suits=tuple(SUIT_TO_NUMBER.keys())):
+    """
+    Inverse of card_to_index.
+    :param index: an integer in [0, 52).
+    :param suits: a tuple of suits, ordered by their number.
+    :return: a card.
+    """
+    return f"{suits[index % 4]}{index // 4 + 2}"
+
+
+INDEX_OF_CARD = {index_to_card(index): index for index in range(NUMBER_OF_CARDS)}
+
+
+def hand_to_index(hand):
+    """
+    Maps a 5-card hand to its rank in the combinatorial number system, that is, to a dense integer in
+    [0, NUMBER_OF_HANDS). The order of the cards in the hand does not matter.
+    :param hand: a hand.
+    :return: the index of the hand.
+    """
+    return sum(
+        BINOMIALS[c][i + 1]
+        for i, c in enumerate(sorted(card_to_index(card) for card in hand))
+    )
+
+
+def hand_indices(hands):
+    """
+    Vectorized version of hand_to_index.
+    :param hands: an integer array of shape (n, 5) with card indices, in any order within each hand.
+    :return: an integer array of shape (n,) with the index of each hand.
+    """
+    return BINOMIALS_ARRAY[np.sort(hands, axis=1), np.arange(1, 6)].sum(axis=1)
+
+
+def index_hands(indices):
+    """
+    Inverse of hand_indices.
+    :param indices: an integer array of shape (n,) with hand indices.
+    :return: an integer array of shape (n, 5) with the card indices of each hand, sorted within each hand.
+    """
+    remainders = np.array(indices, dtype=np.int64)
+    hands = np.empty((len(remainders), 5), dtype=np.int64)
+    for i in range(5, 0, -1):
+        # The i-th card is the largest c such that c choose i does not exceed the remainder.
+        hands[:, i - 1] = (
+            np.searchsorted(BINOMIALS_ARRAY[:, i], remainders, side="right") - 1
+        )
+        remainders -= BINOMIALS_ARRAY[hands[:, i - 1], i]
+    return hands
+
+
+def canonical_suits(*hands):
+    """
+    Computes, for each row, a permutation of suits that maps the row's hands onto their canonical form: suits are
+    relabeled by decreasing ranks held in the first hand, then in the second, and so on. Rows that only differ by a
+    permutation of suits have the same canonical form. Suits that hold the same ranks in every hand are
+    interchangeable, so it does not matter how ties are broken.
+    :param hands: integer arrays of shape (n, *) with card indices (see card_to_index), e.g., both players' hands.
+    :return: an integer array of shape (n, 4) whose row i maps each suit of row i to its canonical suit.
+    """
+    rows = np.arange(len(hands[0]))
+    keys = np.zeros((len(rows), 4), dtype=np.int64)
+    for hand in hands:
+        hand = np.asarray(hand)
+        # The bitmask of the ranks of each suit in the hand.
+        masks = np.zeros((len(rows), 4), dtype=np.int64)
+        for j in range(hand.shape[1]):
+            masks[rows, hand[:, j] % 4] |= 1 << (hand[:, j] // 4)
+        keys = (keys << 13) | masks
+    suits_by_key = np.argsort(-keys, axis=1, kind="stable")
+    permutations = np.empty_like(suits_by_key)
+    permutations[rows[:, None], suits_by_key] = np.arange(4)
+    return permutations
+
+
+def permute_suits(hand, permutations):
+    """
+    :param hand: an integer array of shape (n, *) with card indices.
+    :param permutations: an integer array of shape (n, 4) with a permutation of suits per row.
+    :return: the hand with its suits permuted and sorted within each row.
+    """
+    hand = np.asarray(hand)
+    return np.sort(
+        hand - hand % 4 + np.take_along_axis(permutations, hand % 4, axis=1), axis=1
+    )
+
+
+def canonical_hand_indices(hands):
+    """
+    Computes the index of the canonical form of hands under permutations of suits, so that hands that only differ by
+    a permutation of suits, and thus have the same score, get the same index.
+    :param hands: an integer array of shape (n, 5) with card indices.
+    :return: an integer array of shape (n,) with the index of the canonical form of each hand (see hand_indices).
+    """
+    return hand_indices(permute_suits(hands, canonical_suits(hands)))
+
+
+def cards_to_indices(cards):
+    """
+    Maps cards to their indices.
+    :param cards: a list of cards, or a list of lists of cards, e.g., a list of draws of dealer cards.
+    :return: an integer array with the same shape as cards.
+    """
+    return np.vectorize(INDEX_OF_CARD.__getitem__, otypes=[np.int64])(cards)
+
+
+# Functions called as hook(description, seconds) whenever loading the rank table is timed.
+TIMING_HOOKS = []
+
+
+def add_timing_hook(hook):
+    """
+    Registers a function to be called as hook(description, seconds) with the time it takes to load the rank table.
+    :param hook: a function.
+    """
+    TIMING_HOOKS.append(hook)
+
+
+def report_timing(description, seconds):
+    for hook in TIMING_HOOKS:
+        hook(description, seconds)
+
+
+class RankTable:
+    """
+    Scores of all 5-card hands, indexed by hand_to_index. Each hand stores the ordinal of its score among all
+    distinct scores, so that comparing two hands is comparing two integers. Floored scores get their own ordinals.
+    """
+
+    def __init__(self, ordinals, floor_ordinals, values):
+        # ordinals[i] is the position of the score of hand i in values.
+        self.ordinals = ordinals
+        # floor_ordinals[i] is the position of the floor of the score of hand i among all distinct floored scores.
+        self.floor_ordinals = floor_ordinals
+        # values is the sorted array of distinct scores.
+        self.values = values
+
+    def get_ordinals(self, do_floor):
+        return self.floor_ordinals if do_floor else self.ordinals
+
+    def score(self, index, do_floor):
+        value = float(self.values[self.ordinals[index]])
+        return math.floor(value) if do_floor else value
+
+
+def build_rank_table(hand_indices, scores):
+    """
+    Builds a rank table from hands indices and their scores.
+    :param hand_indices: an integer array with the index of each hand.
+    :param scores: a float array with the score of each hand.
+    :return: a RankTable.
+    """
+    # Scores have at most five decimal places. Rounding removes floating point noise so that, e.g., two pair
+    # 6 6 5 5 4 and two pair 6 6 4 4 14 tie at 36.054.
+    values, ordinals = np.unique(np.round(scores, 5), return_inverse=True)
+    _, floor_ordinals = np.unique(np.floor(values), return_inverse=True)
+    table_ordinals = np.zeros(NUMBER_OF_HANDS, dtype=np.uint16)
+    table_ordinals[hand_indices] = ordinals
+    return RankTable(
+        ordinals=table_ordinals,
+        floor_ordinals=floor_ordinals.astype(np.uint16)[table_ordinals],
+        values=values,
+    )
+
+
+def read_csv_scores(path=RANKS_CSV_PATH):
+    """
+    Reads the CSV with the scores of all hands, as written by generate_ranks.py.
+    :param path: the path to the zipped CSV.
+    :return: an integer array with the index of each hand and a float array with the score of each hand.
+    """
     start_time = time.time()
-    ranks = pd.read_csv("ranks.zip", compression="zip")
-    end_time = time.time()
-    print(f"took {end_time - start_time} sec to read dataframe with hands scores")
+    ranks = pd.read_csv(path, compression="zip", float_precision="round_trip")
+    report_timing("read csv with hands scores", time.time() - start_time)
+
+    # Hands are stored as strings, e.g., "['H2' 'H3' 'H4' 'H5' 'S7']".
+    cards = (
+        " ".join(ranks["hands"].tolist())
+        .translate(str.maketrans("", "", "[]'"))
+        .split()
+    )
+    card_indices = np.fromiter(
+        (INDEX_OF_CARD[card] for card in cards), dtype=np.int64, count=len(cards)
+    ).reshape(-1, 5)
+    return hand_indices(card_indices), ranks["value"].to_numpy()
+
 
+def get_rank_table_from_csv(path=RANKS_CSV_PATH):
+    """
+    Builds a rank table from the CSV with the scores of all hands, as written by generate_ranks.py.
+    :param path: the path to the zipped CSV.
+    :return: a RankTable.
+    """
     start_time = time.time()
-    ranks_score_dict = {}
-    for row in ranks.itertuples(index=True, name="Pandas"):
-        ranks_score_dict[row.hands] = row.value
-    end_time = time.time()
-    print(f"took {end_time - start_time} to create dict with hands scores")
+    rank_table = build_rank_table(*read_csv_scores(path))
+    report_timing("create rank table with hands scores", time.time() - start_time)
+    return rank_table
 
-    return ranks_score_dict
 
+def save_rank_table(rank_table, path=RANKS_PATH, values_path=RANK_VALUES_PATH):
+    """
+    Saves a rank table in the binary format read by load_rank_table.
+    :param rank_table: a RankTable.
+    :param path: where to save the ordinals.
+    :param values_path: where to save the distinct scores.
+    """
+    save_array(path, np.stack([rank_table.ordinals, rank_table.floor_ordinals]))
+    save_array(values_path, rank_table.values)
 
-HANDS_RANKS_SCORE_DICT = None
+
+def save_array(path, array):
+    """
+    Saves an array in .npy format, atomically (see atomic_write).
+    :param path: where to save the array.
+    :param array: a numpy array.
+    """
+    with atomic_write(path) as array_file:
+        np.save(array_file, array)
+
+
+@contextmanager
+def atomic_write(path):
+    """
+    Opens a temporary file, unique to the writer, in the same directory as path, and replaces the file at path with
+    it once it is written and fsync-ed. A process that loads the file, a crash while writing it, or other processes
+    writing it at the same time never leave a partial file at path.
+    :param path: the file to write.
+    :return: the temporary file, open for writing in binary mode.
+    """
+    path = Path(path)
+    tmp_path = path.with_name(f".{path.name}.{os.getpid()}.{uuid.uuid4().hex}.tmp")
+    try:
+        with open(tmp_path, "xb") as tmp_file:
+            yield tmp_file
+            tmp_file.flush()
+            os.fsync(tmp_file.fileno())
+        os.replace(tmp_path, path)
+    finally:
+        tmp_path.unlink(missing_ok=True)
+
+
+@contextmanager
+def file_lock(path):
+    """
+    Holds an exclusive lock on a file, shared by all processes, e.g., so that only one of them builds a file that
+    others then load.
+    :param path: the lock file, created if it does not exist.
+    """
+    with open(path, "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def load_rank_table(path=RANKS_PATH, values_path=RANK_VALUES_PATH):
+    """
+    Loads a rank table saved by save_rank_table. The ordinals are memory-mapped, so loading takes milliseconds
+    and the pages are shared through the OS page cache by every process that loads the same file.
+    :param path: where the ordinals are saved.
+    :param values_path: where the distinct scores are saved.
+    :return: a RankTable.
+    """
+    start_time = time.time()
+    ordinals = np.load(path, mmap_mode="r")
+    rank_table = RankTable(
+        ordinals=ordinals[0], floor_ordinals=ordinals[1], values=np.load(values_path)
+    )
+    report_timing("load rank table", time.time() - start_time)
+    return rank_table
+
+
+def convert_rank_table(
+    csv_path=RANKS_CSV_PATH, path=RANKS_PATH, values_path=RANK_VALUES_PATH
+):
+    """
+    One-time conversion of the CSV with the scores of all hands into the binary format read by load_rank_table.
+    :param csv_path: the path to the zipped CSV.
+    :param path: where to save the ordinals.
+    :param values_path: where to save the distinct scores.
+    """
+    save_rank_table(get_rank_table_from_csv(csv_path), path, values_path)
+
+
+def save_canonical_rank_table(rank_table, path=RANKS_CANONICAL_PATH):
+    """
+    Saves a rank table in canonical form: hands that only differ by a permutation of suits have the same score, so
+    only the ordinals of the 134,459 canonical hands (see canonical_hand_indices) are saved, in about a tenth of the
+    space. load_canonical_rank_table expands it back.
+    :param rank_table: a RankTable.
+    :param path: where to save the rank table, a .npz file.
+    """
+    canonical_indices = np.unique(
+        canonical_hand_indices(index_hands(np.arange(NUMBER_OF_HANDS)))
+    )
+    with atomic_write(path) as canonical_file:
+        np.savez_compressed(
+            canonical_file,
+            canonical_indices=canonical_indices.astype(np.int32),
+            ordinals=rank_table.ordinals[canonical_indices],
+            floor_ordinals=rank_table.floor_ordinals[canonical_indices],
+            values=rank_table.values,
+        )
+
+
+def load_canonical_rank_table(path=RANKS_CANONICAL_PATH):
+    """
+    Loads a rank table saved by save_canonical_rank_table, expanding it to all hands.
+    :param path: where the rank table is saved.
+    :return: a RankTable.
+    """
+    start_time = time.time()
+    with np.load(path) as canonical_rank_table:
+        positions = np.searchsorted(
+            canonical_rank_table["canonical_indices"],
+            canonical_hand_indices(index_hands(np.arange(NUMBER_OF_HANDS))),
+        )
+        rank_table = RankTable(
+            ordinals=canonical_rank_table["ordinals"][positions],
+            floor_ordinals=canonical_rank_table["floor_ordinals"][positions],
+            values=canonical_rank_table["values"],
+        )
+    report_timing("expand canonical rank table", time.time() - start_time)
+    return rank_table
+
+
+HAND_RANK_TABLE = None
+
+
+def get_rank_table():
+    """
+    Implements a singleton on variable HAND_RANK_TABLE so that it is loaded only once. If the binary rank table
+    does not exist yet, it is first expanded from the canonical rank table, if it exists, or else converted from the
+    CSV, by one process at a time, so processes that start together build it once.
+    :return: the RankTable.
+    """
+    global HAND_RANK_TABLE
+    if HAND_RANK_TABLE is None:
+        if not Path(RANKS_PATH).is_file():
+            with file_lock(f"{RANKS_PATH}.lock"):
+                if not Path(RANKS_PATH).is_file():
+                    if Path(RANKS_CANONICAL_PATH).is_file():
+                        save_rank_table(load_canonical_rank_table())
+                    else:
+                        convert_rank_table()
+        HAND_RANK_TABLE = load_rank_table()
+    return HAND_RANK_TABLE
+
+
+class SharedRankTable:
+    """
+    Publishes a rank table into a shared-memory segment, so that worker processes attach to it without copying
+    (see attach_shared_rank_table) and all of them together cost about the same memory as one. The process that
+    publishes the table owns the segment: use it as a context manager, or call close, to unlink the segment once
+    the workers are done.
+    """
+
+    def __init__(self, rank_table=None):
+        rank_table = get_rank_table() if rank_table is None else rank_table
+        # The segment holds the distinct scores followed by the ordinals and the floor ordinals.
+        self.num_values = len(rank_table.values)
+        self.shared_memory = shared_memory.SharedMemory(
+            create=True, size=8 * self.num_values + 4 * NUMBER_OF_HANDS
+        )
+        shared_rank_table = view_rank_table(self.shared_memory.buf, self.num_values)
+        shared_rank_table.values[:] = rank_table.values
+        shared_rank_table.ordinals[:] = rank_table.ordinals
+        shared_rank_table.floor_ordinals[:] = rank_table.floor_ordinals
+
+    @property
+    def handle(self):
+        """
+        What a worker needs to attach to the segment, see attach_shared_rank_table.
+        """
+        return self.shared_memory.name, self.num_values
+
+    def close(self):
+        self.shared_memory.close()
+        self.shared_memory.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def view_rank_table(buffer, num_values):
+    """
+    Views a buffer laid out as in SharedRankTable as a rank table, without copying.
+    :param buffer: the buffer.
+    :param num_values: the number of distinct scores.
+    :return: a RankTable.
+    """
+    values = np.ndarray((num_values,), dtype=np.float64, buffer=buffer)
+    ordinals = np.ndarray(
+        (2, NUMBER_OF_HANDS), dtype=np.uint16, buffer=buffer, offset=values.nbytes
+    )
+    return RankTable(ordinals=ordinals[0], floor_ordinals=ordinals[1], values=values)
+
+
+# The shared-memory segment attached to by this process, kept open as long as the process uses it.
+ATTACHED_SHARED_MEMORY = None
+
+
+def attach_shared_rank_table(handle):
+    """
+    Makes this process score hands with a rank table published by SharedRankTable, without copying it. Meant to be
+    the initializer of worker processes, e.g., ProcessPoolExecutor(initializer=attach_shared_rank_table,
+    initargs=(shared_rank_table.handle,)).
+    :param handle: the handle of a SharedRankTable.
+    """
+    global ATTACHED_SHARED_MEMORY, HAND_RANK_TABLE
+    name, num_values = handle
+    # Worker processes share the resource tracker of the publishing process, so attaching does not make the segment
+    # outlive or die with this process: only SharedRankTable.close unlinks it.
+    ATTACHED_SHARED_MEMORY = shared_memory.SharedMemory(name=name)
+    HAND_RANK_TABLE = view_rank_table(ATTACHED_SHARED_MEMORY.buf, num_values)
 
 
 def get_hand_score(hand, do_floor):
     """
-    Scores a given hand. Implements a singleton on variable HANDS_RANKS_SCORE_DICT
-    so that it is loaded into memory only once.
+    Scores a given hand.
     :param hand: a hand.
     :param do_floor: floors card scores.
     :return:  the score of the hand.
     """
-    global HANDS_RANKS_SCORE_DICT
-    if HANDS_RANKS_SCORE_DICT is None:
-        HANDS_RANKS_SCORE_DICT = get_scores_dict()
-    return (
-        HANDS_RANKS_SCORE_DICT[str(hand).replace(",", "")]
-        if not do_floor
-        else math.floor(HANDS_RANKS_SCORE_DICT[str(hand).replace(",", "")])
+    return get_rank_table().score(hand_to_index(hand), do_floor)
+
+
+def get_hand_ordinal(hand, do_floor):
+    """
+    Computes the ordinal of the score of a given hand. Comparing the ordinals of two hands is the same as comparing
+    their scores.
+    :param hand: a hand.
+    :param do_floor: floors card scores.
+    :return: the ordinal of the score of the hand.
+    """
+    return int(get_rank_table().get_ordinals(do_floor)[hand_to_index(hand)])
+
+
+def get_completed_hands_ordinals(kept_cards, dealer_cards, do_floor):
+    """
+    Completes a kept hand with each of many draws of dealer cards and computes the ordinals of the completed hands.
+    :param kept_cards: an integer array with the card indices of the kept hand.
+    :param dealer_cards: an integer array of shape (m, k) with card indices, one draw of dealer cards per row.
+    :param do_floor: floors card scores.
+    :return: an integer array of shape (m,) with the ordinal of each completed hand.
+    """
+    hands = np.concatenate(
+        [
+            np.broadcast_to(kept_cards, (len(dealer_cards), len(kept_cards))),
+            dealer_cards,
+        ],
+        axis=1,
     )
+    return get_rank_table().get_ordinals(do_floor)[hand_indices(hands)].astype(np.int64)
 
 
 def left_hand_points(
@@ -47,15 +505,17 @@ def left_hand_points(
     right_hand,
     do_floor,
 ):
-    if get_hand_score(left_hand, do_floor) > get_hand_score(right_hand, do_floor):
+    left_ordinal = get_hand_ordinal(left_hand, do_floor)
+    right_ordinal = get_hand_ordinal(right_hand, do_floor)
+    if left_ordinal > right_ordinal:
         return 1
-    elif get_hand_score(left_hand, do_floor) < get_hand_score(right_hand, do_floor):
+    elif left_ordinal < right_ordinal:
         return -1
     else:
         return 0
 
 
-def compare_cards(x, y, suit_to_number={"H": 0, "S": 1, "C": 2, "D": 3}):
+def compare_cards(x, y, suit_to_number=SUIT_TO_NUMBER):
     suit_x, rank_x = x[0], int(x[1:])
     suit_y, rank_y = y[0], int(y[1:])
     assert 2 <= rank_x <= 14 and 2 <= rank_y <= 14
@@ -72,3 +532,12 @@ def append_cards(initial_hand, new_cards):
     new_hand = initial_hand + new_cards
     new_hand.sort(key=functools.cmp_to_key(compare_cards))
     return new_hand
+
+
+if __name__ == "__main__":
+    add_timing_hook(
+        lambda description, seconds: print(f"took {seconds} sec to {description}")
+    )
+    convert_rank_table()
+    save_canonical_rank_table(load_rank_table())
+    load_canonical_rank_table()
@@ -1,7 +1,12 @@
 import math
 
-from poker import sample_game, simulate_game
-import itertools as it
+from poker import (
+    iter_all_dealer_cards,
+    sample_game,
+    score_kept_hands,
+    simulate_game,
+    simulate_game_from_ordinals,
+)
 import pprint
 
 
@@ -27,7 +32,49 @@ def compute_strategy_profile_stats(strategy_profile, dealer_cards, game, do_floo
     return {"mean": mean, "variance": variance}
 
 
-def compute_game_stats(game, do_floor):
+def compute_exact_sums(game, strategy_profiles, do_floor, chunk_size=2 ** 16):
+    """
+    Given a game, computes the sum of scores and sum of scores squared of the given strategy profiles over every
+    possible draw of dealer cards. Draws are streamed in chunks, and in each chunk every distinct kept hand is scored
+    once, so memory stays bounded. Strategy profiles are simulated once per class of equal payoffs.
+    :param game: a poker game.
+    :param strategy_profiles: an iterable of strategy profiles, valid in the given game.
+    :param do_floor: floors card scores.
+    :param chunk_size: the maximum number of draws of dealer cards processed at once.
+    :return: a map from strategy profiles to their sums, and the number of draws of dealer cards.
+    """
+    # Strategy profiles with the same representative pair of discard choices have the same sums, see
+    # Game.compute_representative_pair_ids, so only representatives are simulated.
+    pair_ids = {sp: game.get_representative_pair_id(sp) for sp in strategy_profiles}
+    pair_sums = {pair_id: [0, 0] for pair_id in set(pair_ids.values())}
+    index_discards = {
+        pair_id: game.get_index_discards(pair_id) for pair_id in pair_sums
+    }
+    num_outcomes = 0
+    for dealer_cards in iter_all_dealer_cards(game, chunk_size):
+        p1_ordinals = score_kept_hands(
+            game, "p1", {d[0] for d in index_discards.values()}, dealer_cards, do_floor
+        )
+        p2_ordinals = score_kept_hands(
+            game, "p2", {d[1] for d in index_discards.values()}, dealer_cards, do_floor
+        )
+        for pair_id, sums in pair_sums.items():
+            p1_index_discard, p2_index_discard = index_discards[pair_id]
+            (
+                total_sum_p1_points,
+                total_sum_p1_points_squared,
+            ) = simulate_game_from_ordinals(
+                p1_ordinals[p1_index_discard], p2_ordinals[p2_index_discard]
+            )
+            sums[0] += total_sum_p1_points
+            sums[1] += total_sum_p1_points_squared
+        num_outcomes += len(dealer_cards)
+    return {
+        sp: list(pair_sums[pair_id]) for sp, pair_id in pair_ids.items()
+    }, num_outcomes
+
+
+def compute_game_stats(game, do_floor, chunk_size=2 ** 16):
     """
     Given a game, computes a map as follows:
         {strategy_profile :
@@ -36,15 +83,18 @@ def compute_game_stats(game, do_floor):
         }
     :param game: a poker game.
     :param do_floor:
+    :param chunk_size: the maximum number of draws of dealer cards processed at once.
     :return: a map that contains the game statistics, that is, for each profile, mean and variance.
     """
-    dealer_cards_of_game = [
-        list(x) for x in it.combinations(game["deck"], game["num_discard_cards"])
-    ]
-    return {
-        sp: compute_strategy_profile_stats(sp, dealer_cards_of_game, game, do_floor)
-        for sp in game["strategy_profiles"].keys()
-    }
+    sums, num_outcomes = compute_exact_sums(
+        game, game["strategy_profiles"].keys(), do_floor, chunk_size
+    )
+    game_stats = {}
+    for sp, (total_sum_p1_points, total_sum_p1_points_squared) in sums.items():
+        mean = total_sum_p1_points / num_outcomes
+        variance = (total_sum_p1_points_squared / num_outcomes) - mean ** 2
+        game_stats[sp] = {"mean": mean, "variance": variance}
+    return game_stats
 
 
 def compute_v_inf(game_stats):
@@ -1,16 +1,99 @@
+import itertools as it
+import math
+import multiprocessing
+import os
+import pickle
+import random
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
 from unittest import TestCase
-from score_hands import append_cards, get_hand_score, left_hand_points
-from poker import create_game
+
+import numpy as np
+import pandas as pd
+
+from algorithms import (
+    AnytimeBound,
+    UnionBound,
+    compute_epsilons,
+    compute_stats,
+    eliminate_dominated_strategies,
+    load_psp_state,
+    psp,
+    psp_iter,
+    psp_sweep,
+    save_psp_state,
+)
+from benchmarks import compare_to_baseline, run_benchmarks
+from generate_ranks import all_hands, score_hand, score_hands_vectorized
+from score_hands import (
+    add_timing_hook,
+    append_cards,
+    attach_shared_rank_table,
+    canonical_hand_indices,
+    canonical_suits,
+    card_to_index,
+    cards_to_indices,
+    get_hand_score,
+    hand_to_index,
+    index_hands,
+    index_to_card,
+    get_rank_table,
+    hand_indices,
+    load_canonical_rank_table,
+    left_hand_points,
+    load_rank_table,
+    NUMBER_OF_HANDS,
+    save_canonical_rank_table,
+    save_rank_table,
+    SharedRankTable,
+    TIMING_HOOKS,
+)
+from experiments_pair import PAIR_EXPERIMENT_SCHEMA
+from game_stats_cache import GameStatsCache
+from manifest import RunManifest
+from results_sink import read_results, ResultsSink
+from stats import (
+    compute_game_stats,
+    compute_strategy_profile_stats,
+    compute_v_1_inf,
+    compute_v_inf,
+)
+from poker import (
+    create_game,
+    draw_dealer_cards,
+    draw_randomness,
+    get_deck,
+    sample_game,
+    simulate_game,
+    simulate_game_batch,
+)
+
+
+def save_rank_table_at_once(barrier, *arguments):
+    """
+    Saves a rank table once every process sharing the barrier is ready, so that all of them save at the same time.
+    """
+    barrier.wait()
+    save_rank_table(*arguments)
 
 
 class Test(TestCase):
     def test_left_hand_points(self):
         some_left_hand = ["D7", "D11", "D12", "D13", "D14"]
         some_right_hand = ["D10", "D11", "D12", "D13", "D14"]
-        assert left_hand_points(some_left_hand, some_right_hand) == -1
-        assert left_hand_points(some_right_hand, some_left_hand) == 1
-        assert left_hand_points(some_right_hand, some_right_hand) == 0
-        assert left_hand_points(some_left_hand, some_left_hand) == 0
+        for do_floor in [False, True]:
+            assert left_hand_points(some_left_hand, some_right_hand, do_floor) == -1
+            assert left_hand_points(some_right_hand, some_left_hand, do_floor) == 1
+            assert left_hand_points(some_right_hand, some_right_hand, do_floor) == 0
+            assert left_hand_points(some_left_hand, some_left_hand, do_floor) == 0
+
+        # Two high-card hands that only differ once scores are floored.
+        some_left_hand = ["S2", "C3", "D4", "C5", "H7"]
+        some_right_hand = ["S2", "C3", "D4", "C6", "H7"]
+        assert left_hand_points(some_left_hand, some_right_hand, False) == -1
+        assert left_hand_points(some_left_hand, some_right_hand, True) == 0
 
     def test_compare_cards(self):
 
@@ -18,32 +101,736 @@ class Test(TestCase):
         more_cards = ["C4", "S3"]
         new_hand = append_cards(some_incomplete_hand, more_cards)
         assert new_hand == ["S3", "C4", "D7", "C11", "D12"]
-        assert 0 < get_hand_score(new_hand) <= 134
+        assert 0 < get_hand_score(new_hand, do_floor=False) <= 134
 
         some_incomplete_hand = ["C4", "D2", "S2", "S14"]
         more_cards = ["C3"]
         new_hand = append_cards(some_incomplete_hand, more_cards)
         assert new_hand == ["S2", "D2", "C3", "C4", "S14"]
-        assert 0 < get_hand_score(new_hand) <= 134
+        assert 0 < get_hand_score(new_hand, do_floor=False) <= 134
 
         some_incomplete_hand = ["H14", "S14"]
         more_cards = ["C3", "D3", "S3"]
         new_hand = append_cards(some_incomplete_hand, more_cards)
         assert new_hand == ["S3", "C3", "D3", "H14", "S14"]
-        assert 0 < get_hand_score(new_hand) <= 134
+        assert 0 < get_hand_score(new_hand, do_floor=False) <= 134
+        assert get_hand_score(new_hand, do_floor=True) == 93
+
+    def test_hand_to_index(self):
+        deck = get_deck()
+        assert [index_to_card(card_to_index(card)) for card in deck] == deck
+        assert sorted(card_to_index(card) for card in deck) == list(range(52))
+
+        hand = ["H2", "S2", "C2", "D2", "H3"]
+        assert hand_to_index(hand) == 0
+        assert hand_to_index(hand[::-1]) == 0
+        assert hand_to_index(["C13", "H14", "S14", "C14", "D14"]) == NUMBER_OF_HANDS - 2
+        assert hand_to_index(["D13", "H14", "S14", "C14", "D14"]) == NUMBER_OF_HANDS - 1
+
+        # The index is a bijection between hands of the first 12 cards and [0, C(12, 5)).
+        sorted_deck = append_cards(deck, [])
+        indices = {hand_to_index(hand) for hand in it.combinations(sorted_deck[:12], 5)}
+        assert indices == set(range(792))
+
+    def test_rank_table_binary_format(self):
+        rank_table = get_rank_table()
+        timings = []
+        hook = lambda description, seconds: timings.append(description)
+        add_timing_hook(hook)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, "ranks.npy")
+            values_path = os.path.join(tmp_dir, "ranks_values.npy")
+            save_rank_table(rank_table, path, values_path)
+            loaded_rank_table = load_rank_table(path, values_path)
+            assert isinstance(loaded_rank_table.ordinals, np.memmap)
+            assert np.array_equal(loaded_rank_table.ordinals, rank_table.ordinals)
+            assert np.array_equal(
+                loaded_rank_table.floor_ordinals, rank_table.floor_ordinals
+            )
+            assert np.array_equal(loaded_rank_table.values, rank_table.values)
+            # Saving again replaces the files, and leaves no temporary file, while the loaded table is mapped.
+            save_rank_table(rank_table, path, values_path)
+            assert sorted(os.listdir(tmp_dir)) == ["ranks.npy", "ranks_values.npy"]
+            assert np.array_equal(loaded_rank_table.ordinals, rank_table.ordinals)
+            del loaded_rank_table
+
+            # Processes that save to the same paths at the same time do not fail, and leave a complete table.
+            with multiprocessing.Manager() as manager, multiprocessing.Pool(8) as pool:
+                barrier = manager.Barrier(8)
+                pool.starmap(
+                    save_rank_table_at_once,
+                    [(barrier, rank_table, path, values_path)] * 8,
+                    chunksize=1,
+                )
+            assert sorted(os.listdir(tmp_dir)) == ["ranks.npy", "ranks_values.npy"]
+            loaded_rank_table = load_rank_table(path, values_path)
+            assert np.array_equal(loaded_rank_table.ordinals, rank_table.ordinals)
+            del loaded_rank_table
+        TIMING_HOOKS.remove(hook)
+        assert "load rank table" in timings
+
+    def test_score_hands_vectorized(self):
+        hands = all_hands()
+        assert np.array_equal(hand_indices(hands), np.arange(NUMBER_OF_HANDS))
+
+        some_hands = hands[np.random.default_rng(0).choice(NUMBER_OF_HANDS, 5000)]
+        some_hands = np.concatenate(
+            [
+                some_hands,
+                [
+                    [card_to_index(card) for card in hand]
+                    for hand in [
+                        ["H10", "H11", "H12", "H13", "H14"],
+                        ["S2", "S3", "S4", "S5", "S14"],
+                        ["H2", "S3", "S4", "S5", "S14"],
+                        ["H4", "H5", "S5", "H6", "S6"],
+                        ["H3", "S3", "C3", "H4", "S4"],
+                    ]
+                ],
+            ]
+        )
+        scores = score_hands_vectorized(some_hands)
+        for hand, score in zip(some_hands, scores):
+            assert score == score_hand([index_to_card(card) for card in hand])
+        assert np.array_equal(
+            get_rank_table().values[
+                get_rank_table().ordinals[hand_indices(some_hands)]
+            ],
+            np.round(scores, 5),
+        )
+
+    def test_canonical_rank_table(self):
+        hands = index_hands(np.arange(0, NUMBER_OF_HANDS, 7))
+        assert np.array_equal(hand_indices(hands), np.arange(0, NUMBER_OF_HANDS, 7))
+        # Hearts and diamonds swapped, and spades and clubs.
+        assert np.array_equal(
+            canonical_hand_indices(hands), canonical_hand_indices(hands ^ 3)
+        )
+        assert canonical_hand_indices(
+            cards_to_indices([["H2", "H3", "S3", "C7", "D14"]])
+        ) == canonical_hand_indices(cards_to_indices([["C2", "C3", "H3", "D7", "S14"]]))
+
+        rank_table = get_rank_table()
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, "ranks_canonical.npz")
+            save_canonical_rank_table(rank_table, path)
+            # The table is written to a temporary file that replaces path.
+            assert os.listdir(tmp_dir) == ["ranks_canonical.npz"]
+            with np.load(path) as canonical_rank_table:
+                assert len(canonical_rank_table["canonical_indices"]) == 134459
+            loaded_rank_table = load_canonical_rank_table(path)
+        assert np.array_equal(loaded_rank_table.ordinals, rank_table.ordinals)
+        assert np.array_equal(
+            loaded_rank_table.floor_ordinals, rank_table.floor_ordinals
+        )
+        assert np.array_equal(loaded_rank_table.values, rank_table.values)
+
+    def test_canonical_game(self):
+        hand_p1 = ["H2", "C2", "C5", "C9", "C11"]
+        hand_p2 = ["H7", "D7", "S3", "D4", "S12"]
+        # This relabeling changes the order of the cards of the hands once sorted.
+        relabel = str.maketrans("HSCD", "DHSC")
+        games = [
+            create_game(
+                {
+                    "deck": [
+                        card.translate(table)
+                        for card in get_deck()
+                        if card not in hand_p1 + hand_p2
+                    ],
+                    "num_discard_cards": 2,
+                    "hand_p1": [card.translate(table) for card in hand_p1],
+                    "hand_p2": [card.translate(table) for card in hand_p2],
+                    "bet_grid": ["*"],
+                }
+            )
+            for table in [{}, relabel]
+        ]
+        assert games[0].canonical_key() == games[1].canonical_key()
+        game_stats = [compute_game_stats(game, do_floor=False) for game in games]
+        for game in games:
+            key, (p1_positions, p2_positions) = game.compute_canonical_form()
+            permutation = canonical_suits(
+                *[
+                    cards_to_indices(cards)[None]
+                    for cards in [game["hand_p1"], game["hand_p2"], game["deck"]]
+                ]
+            )[0]
+            for hand, canonical_hand, positions in [
+                (game["hand_p1"], key[2], p1_positions),
+                (game["hand_p2"], key[3], p2_positions),
+            ]:
+                # Each card lands where its relabeled card is in the canonical hand.
+                for card, position in zip(cards_to_indices(hand), positions):
+                    assert (
+                        canonical_hand[position]
+                        == card - card % 4 + permutation[card % 4]
+                    )
+        for s in games[0]["strategy_profiles"]:
+            assert games[0].canonical_strategy_profile(s) == games[
+                1
+            ].canonical_strategy_profile(s)
+            assert game_stats[0][s] == game_stats[1][s]
+
+    def test_game_stats_cache(self):
+        hand_p1 = ["H2", "C2", "C5", "C9", "C11"]
+        hand_p2 = ["H7", "D7", "S3", "D4", "S12"]
+        # This relabeling changes the order of the cards of the hands once sorted.
+        relabel = str.maketrans("HSCD", "DHSC")
+        games = [
+            create_game(
+                {
+                    "deck": [
+                        card.translate(table)
+                        for card in get_deck()
+                        if card not in hand_p1 + hand_p2
+                    ],
+                    "num_discard_cards": 1,
+                    "hand_p1": [card.translate(table) for card in hand_p1[::step]],
+                    "hand_p2": [card.translate(table) for card in hand_p2],
+                    "bet_grid": ["*"],
+                }
+            )
+            # The hands of the second game are also in another order.
+            for table, step in [({}, -1), (relabel, 1)]
+        ]
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            cache = GameStatsCache(tmp_dir)
+            for game in games:
+                cached_game_stats = cache.get_game_stats(game, False)
+                game_stats = compute_game_stats(game, False)
+                for s, stats in game_stats.items():
+                    assert cached_game_stats[s] == stats
+            # Both games only differ by a permutation of suits, so they share an entry.
+            assert len(list(Path(tmp_dir).glob("*.json"))) == 1
+            game_stats = compute_game_stats(games[0], True)
+            assert cache.get_norms(games[0], True) == (
+                compute_v_inf(game_stats),
+                compute_v_1_inf(game_stats),
+            )
+            assert len(list(Path(tmp_dir).glob("*.json"))) == 2
+
+            # Concurrent workers compute each game once.
+            with ProcessPoolExecutor(max_workers=2) as executor:
+                assert (
+                    list(executor.map(cache.get_norms, games, [False, False]))
+                    == [cache.get_norms(games[0], False)] * 2
+                )
+
+            # Only the most recently used entry fits.
+            cache.max_bytes = max(
+                path.stat().st_size for path in Path(tmp_dir).glob("*.json")
+            )
+            os.utime(next(Path(tmp_dir).glob("*.json")), (0, 0))
+            cache.evict()
+            assert len(list(Path(tmp_dir).glob("*.json"))) == 1
 
     def test_create_game(self):
+        hand_p1 = ["H2", "H3", "D3", "C7", "D14"]
+        hand_p2 = ["D10", "D11", "D12", "D13", "D14"]
         some_game = create_game(
             {
                 "deck": None,
                 "num_discard_cards": 1,
-                "hand_p1": ["H2", "H3", "D3", "C7", "D14"],
-                "hand_p2": ["D10", "D11", "D12", "D13", "D14"],
+                "hand_p1": hand_p1,
+                "hand_p2": hand_p2,
                 "bet_grid": [1, 2],
             }
         )
-        for s in some_game["strategy_profiles"].values():
+        assert some_game["size_of_game"] == len(some_game["strategy_profiles"]) == 100
+        assert list(some_game["strategy_profiles"]) == list(
+            it.product(
+                it.combinations(range(5), 1),
+                [1, 2],
+                it.combinations(range(5), 1),
+                [1, 2],
+            )
+        )
+        for (p1_index_discard, _, p2_index_discard, _), s in some_game[
+            "strategy_profiles"
+        ].items():
+            assert s["p1"]["hand"] == [
+                c for i, c in enumerate(hand_p1) if i not in p1_index_discard
+            ]
+            assert s["p2"]["hand"] == [
+                c for i, c in enumerate(hand_p2) if i not in p2_index_discard
+            ]
             p1_complete_hand = append_cards(s["p1"]["hand"], ["H5"])
             p2_complete_hand = append_cards(s["p2"]["hand"], ["H5"])
-            assert 0 < get_hand_score(p1_complete_hand) <= 134
-            assert 0 < get_hand_score(p2_complete_hand) <= 134
+            assert 0 < get_hand_score(p1_complete_hand, do_floor=False) <= 134
+            assert 0 < get_hand_score(p2_complete_hand, do_floor=False) <= 134
+        assert ((0,), 3, (0,), 1) not in some_game["strategy_profiles"]
+        assert ((0, 1), 1, (0,), 1) not in some_game["strategy_profiles"]
+
+        copied_game = pickle.loads(pickle.dumps(some_game))
+        assert copied_game["id"] == some_game["id"]
+        assert np.array_equal(copied_game.kept_hands_p2, some_game.kept_hands_p2)
+
+    def test_simulate_game_batch(self):
+        for num_discard_cards in [1, 2, 3]:
+            some_game = sample_game(num_discard_cards=num_discard_cards)
+            dealer_cards = draw_randomness(some_game, 200)
+            for s in list(some_game["strategy_profiles"].keys())[:10]:
+                for do_floor in [False, True]:
+                    assert simulate_game_batch(
+                        s, some_game, cards_to_indices(dealer_cards), do_floor
+                    ) == simulate_game(s, some_game, dealer_cards, do_floor)
+
+    def test_draw_dealer_cards(self):
+        some_game = sample_game(num_discard_cards=3, seed=0)
+        dealer_cards = draw_dealer_cards(some_game, 100000)
+        assert dealer_cards.shape == (100000, 3)
+        assert np.isin(dealer_cards, cards_to_indices(some_game["deck"])).all()
+        sorted_dealer_cards = np.sort(dealer_cards, axis=1)
+        assert (sorted_dealer_cards[:, :-1] < sorted_dealer_cards[:, 1:]).all()
+        # Every card is drawn about 3 / 42 of the time.
+        assert np.allclose(
+            np.unique(dealer_cards, return_counts=True)[1] / 100000, 3 / 42, atol=0.005
+        )
+        assert np.array_equal(
+            draw_dealer_cards(some_game, 10, np.random.default_rng(1)),
+            draw_dealer_cards(some_game, 10, np.random.default_rng(1)),
+        )
+
+    def test_psp(self):
+        random.seed(0)
+        some_game = sample_game(num_discard_cards=2, seed=0)
+        game_stats = compute_game_stats(some_game, do_floor=False)
+        psp_stats = psp(some_game, target_epsilon=0.1, target_delta=0.1)
+        assert psp_stats["seed"] == 0
+        psp_stats_1, psp_stats_2 = psp(some_game, 0.1, 0.1, seed=1), psp(
+            some_game, 0.1, 0.1, seed=1
+        )
+        for key in ["estimate_map", "epsilon_map", "emp_simulation_complexity"]:
+            assert psp_stats_1[key] == psp_stats_2[key]
+        for s, stats in game_stats.items():
+            assert (
+                abs(psp_stats["estimate_map"][s] - stats["mean"])
+                <= psp_stats["epsilon_map"][s]
+            )
+
+    def test_compute_epsilons(self):
+        m = 1000
+        U = np.array([0, 10, -500, 900, 1000])
+        V = np.array([0, 800, 700, 950, 1000])
+        epsilons = compute_epsilons(U, V, m, 2.0, 0.05, 10, 100)
+        for i in range(len(U)):
+            assert epsilons[i] == compute_stats(
+                int(U[i]), int(V[i]), m, 2.0, 0.05, 10, 100
+            )
+
+    def test_determined_profiles(self):
+        # Player 1 keeps at least three aces, and player 2 can reach at most a pair.
+        hand_p1 = ["H14", "S14", "C14", "D14", "H2"]
+        hand_p2 = ["H3", "S5", "C7", "D9", "H11"]
+        some_game = create_game(
+            {
+                "deck": [card for card in get_deck() if card not in hand_p1 + hand_p2],
+                "num_discard_cards": 1,
+                "hand_p1": hand_p1,
+                "hand_p2": hand_p2,
+                "bet_grid": ["*"],
+            }
+        )
+        assert (some_game.compute_determined_payoffs(do_floor=False) == 1.0).all()
+        psp_stats = psp(some_game, 0.01, 0.05, seed=0)
+        assert psp_stats["stop_reason"] == "converged"
+        assert psp_stats["num_determined"] == 25
+        assert psp_stats["emp_simulation_complexity"] == 0
+        assert psp_stats["emp_sample_complexity"] == 0
+        assert psp_stats["epsilon"] == psp_stats["nash_epsilon"] == 0
+        # A sweep stops its runs the same way.
+        sweep = psp_sweep(some_game, [(0.01, 1.1), (0.05, 2.0)], 0.05, seed=0)
+        for sweep_stats in sweep.values():
+            for key in [
+                "stop_reason",
+                "num_determined",
+                "emp_sample_complexity",
+                "emp_simulation_complexity",
+                "epsilon",
+                "nash_epsilon",
+                "estimate_map",
+                "epsilon_map",
+            ]:
+                assert sweep_stats[key] == psp_stats[key]
+        game_stats = compute_game_stats(some_game, do_floor=False)
+        for s, stats in game_stats.items():
+            assert psp_stats["estimate_map"][s] == stats["mean"] == 1
+            assert psp_stats["epsilon_map"][s] == stats["variance"] == 0
+
+        # Determined payoffs are found in random games, and match the exact stats.
+        random.seed(1018)
+        some_game = sample_game(num_discard_cards=1)
+        game_stats = compute_game_stats(some_game, do_floor=True)
+        determined_payoffs = some_game.get_determined_payoffs(do_floor=True)
+        assert 0 < np.count_nonzero(~np.isnan(determined_payoffs)) < 25
+        for s, payoff in zip(some_game["strategy_profiles"], determined_payoffs):
+            if not math.isnan(payoff):
+                assert game_stats[s]["mean"] == payoff
+                assert game_stats[s]["variance"] == 0
+
+    def test_bounds(self):
+        U = np.array([0, 10, -500, 900])
+        V = np.array([0, 800, 700, 950])
+        union_bound = UnionBound(0.01, 0.05, 2.0, 1.1, 100, 11480)
+        assert (
+            union_bound.compute_epsilons(U, V, 1000, 1)
+            == compute_epsilons(U, V, 1000, 2.0, 0.05, len(union_bound.schedule), 100)
+        ).all()
+
+        anytime_bound = AnytimeBound(0.01, 0.05, 2.0, 1.05, 100, 11480)
+        schedule = anytime_bound.schedule
+        assert all(m < n for m, n in zip(schedule, schedule[1:]))
+        assert schedule[-2] < 11480 < schedule[-1] - schedule[-2]
+        # The failure probabilities of the iterations sum to at most delta.
+        assert (
+            sum(
+                3 * 100 / math.exp(anytime_bound.get_log_term(t))
+                for t in range(1, 10 ** 5)
+            )
+            <= 0.05
+        )
+        epsilons = [anytime_bound.compute_epsilons(U, V, 1000, t) for t in [1, 2]]
+        assert (epsilons[0] < epsilons[1]).all()
+
+        random.seed(0)
+        some_game = sample_game(num_discard_cards=3)
+        psp_stats = psp(some_game, 0.05, 0.05, beta=1.05, seed=0, bound="anytime")
+        assert (
+            psp_stats["schedule"]
+            == AnytimeBound(
+                0.05, 0.05, 2.0, 1.05, some_game["size_of_game"], 11480
+            ).schedule
+        )
+        assert psp_stats["stop_reason"] in ["converged", "exact"]
+        assert psp_stats["epsilon"] <= 0.05
+
+    def test_psp_exact(self):
+        random.seed(0)
+        some_game = sample_game(num_discard_cards=1)
+        game_stats = compute_game_stats(some_game, do_floor=True)
+        psp_stats = psp(
+            some_game, target_epsilon=0.01, target_delta=0.05, do_floor=True
+        )
+        assert psp_stats["exact"]
+        assert psp_stats["emp_sample_complexity"] == len(some_game["deck"]) == 42
+        assert psp_stats["emp_simulation_complexity"] == 42 * 25
+        for s, stats in game_stats.items():
+            assert psp_stats["epsilon_map"][s] == 0
+            assert psp_stats["estimate_map"][s] == stats["mean"]
+            assert math.isclose(psp_stats["variance_map"][s], stats["variance"])
+
+    def test_psp_callback(self):
+        random.seed(0)
+        some_game = sample_game(num_discard_cards=2)
+        metrics = []
+        psp_stats = psp(some_game, 0.1, 0.05, seed=0, callback=metrics.append)
+        assert (
+            psp_stats["epsilon_map"] == psp(some_game, 0.1, 0.05, seed=0)["epsilon_map"]
+        )
+        assert [m["active_set_len"] for m in metrics] == psp_stats["active_set_len"]
+        for m in metrics:
+            if not m["exact"]:
+                assert (
+                    m["epsilon"]["min"] <= m["epsilon"]["median"] <= m["epsilon"]["max"]
+                )
+                assert m["seconds"].keys() == {
+                    "sample",
+                    "score",
+                    "simulate",
+                    "compute_stats",
+                    "prune",
+                }
+
+    def test_psp_iter(self):
+        random.seed(0)
+        some_game = sample_game(num_discard_cards=3)
+        snapshots = []
+        iterations = list(psp_iter(some_game, 0.05, 0.05, seed=0))
+        for psp_stats in iterations:
+            snapshots.append(
+                (
+                    psp_stats["emp_simulation_complexity"],
+                    np.count_nonzero(psp_stats["active"]),
+                )
+            )
+            # Every snapshot has its maps, which later iterations do not modify.
+            assert len(psp_stats["active_set"]) == snapshots[-1][1]
+            assert psp_stats["estimate_map"] == dict(
+                zip(psp_stats["profiles"], psp_stats["estimates"].tolist())
+            )
+        assert len(iterations) > 1
+        assert iterations[0]["emp_simulation_complexity"] < snapshots[-1][0]
+        assert (
+            psp_stats["epsilon_map"]
+            == psp(some_game, 0.05, 0.05, seed=0)["epsilon_map"]
+        )
+        assert len(psp_stats["active_set"]) == snapshots[-1][1]
+        assert psp_stats["stop_reason"] in ["converged", "exact", "schedule_end"]
+        assert len(snapshots) == len(psp_stats["active_set_len"])
+        assert [num_active for _, num_active in snapshots[:-1]] == psp_stats[
+            "active_set_len"
+        ][1:]
+
+        # Stop when the next iteration would exceed the budget.
+        max_simulations = snapshots[0][0] + 1
+        psp_stats = psp(some_game, 0.05, 0.05, seed=0, max_simulations=max_simulations)
+        assert psp_stats["stop_reason"] == "max_simulations"
+        assert psp_stats["emp_simulation_complexity"] == snapshots[0][0]
+        assert psp_stats["epsilon"] == max(psp_stats["epsilon_map"].values()) > 0.05
+
+        psp_stats = psp(some_game, 0.05, 0.05, seed=0, deadline=time.time())
+        assert psp_stats["stop_reason"] == "deadline"
+        assert psp_stats["emp_simulation_complexity"] == 0
+        assert psp_stats["epsilon"] == math.inf
+
+    def test_eliminate_dominated_strategies(self):
+        # Player 1's second strategy is dominated, and then player 2's first one, given the second row only.
+        estimates = np.array([0.5, -0.2, 0.0, -0.5])
+        epsilons = np.array([0.1, 0.1, 0.1, 0.1])
+        assert eliminate_dominated_strategies(estimates, epsilons, 2).tolist() == [
+            True,
+            False,
+            True,
+            True,
+        ]
+        # With wider confidence intervals, nothing is eliminated.
+        assert not eliminate_dominated_strategies(estimates, epsilons * 3, 2).any()
+
+        random.seed(0)
+        some_game = sample_game(num_discard_cards=3)
+        psp_stats = psp(some_game, 0.05, 0.05, seed=0)
+        pruned_psp_stats = psp(some_game, 0.05, 0.05, seed=0, eliminate_dominated=True)
+        assert (
+            pruned_psp_stats["emp_simulation_complexity"]
+            < psp_stats["emp_simulation_complexity"]
+        )
+        remaining = ~pruned_psp_stats["eliminated"]
+        assert remaining.any()
+        assert pruned_psp_stats["nash_epsilon"] == 2 * max(
+            pruned_psp_stats["epsilons"][remaining]
+        )
+        assert psp_stats["nash_epsilon"] == 2 * psp_stats["epsilon"]
+
+    def test_psp_state(self):
+        random.seed(0)
+        some_game = sample_game(num_discard_cards=3)
+        psp_stats = psp(some_game, 0.1, 0.05, seed=0)
+        with tempfile.TemporaryDirectory() as tmp:
+            save_psp_state(Path(tmp) / "psp_state.json", psp_stats)
+            psp_state = load_psp_state(Path(tmp) / "psp_state.json")
+        for key in ["epsilon_map", "estimate_map", "stats", "schedule", "rng_state"]:
+            assert psp_state[key] == psp_stats[key]
+
+        # Refine to a tighter epsilon: only profiles above it are reactivated, and keep their samples.
+        refined = psp(some_game, 0.05, 0.05, psp_state=psp_state)
+        reactivated = psp_state["epsilons"] > 0.05
+        num_iterations = len(psp_state["active_set_len"])
+        assert refined["active_set_len"][num_iterations] == reactivated.sum()
+        assert refined["delta"] == 0.1 and psp_state["delta"] == 0.05
+        assert refined["epsilon"] <= 0.05 or refined["stop_reason"] == "schedule_end"
+        assert (
+            refined["num_samples"][reactivated] > psp_state["num_samples"][reactivated]
+        ).all()
+        assert (refined["U"][~reactivated] == psp_state["U"][~reactivated]).all()
+        assert (
+            refined["emp_simulation_complexity"]
+            - psp_state["emp_simulation_complexity"]
+            == (refined["num_samples"] - psp_state["num_samples"]).sum()
+        )
+
+        # Profiles already within the target are not simulated again.
+        assert (
+            psp(some_game, 0.5, 0.05, psp_state=psp_state)["stop_reason"] == "converged"
+        )
+
+    def test_psp_sweep(self):
+        random.seed(0)
+        some_game = sample_game(num_discard_cards=3)
+        # With one pair, the stream is drawn as psp draws its samples.
+        psp_stats = psp_sweep(some_game, [(0.05, 1.5)], 0.05, seed=0)[(0.05, 1.5)]
+        expected_psp_stats = psp(some_game, 0.05, 0.05, beta=1.5, seed=0)
+        for key in ["emp_simulation_complexity", "stop_reason", "epsilon_map"]:
+            assert psp_stats[key] == expected_psp_stats[key]
+
+        grid = list(it.product([0.02, 0.05, 0.1], [1.5, 2.0]))
+        sweep = psp_sweep(some_game, grid, 0.05, seed=0)
+        assert list(sweep) == grid
+        for (target_epsilon, beta), psp_stats in sweep.items():
+            assert psp_stats["stop_reason"] in ["converged", "exact", "schedule_end"]
+            assert len(psp_stats["active_set_len"]) <= len(psp_stats["schedule"])
+            if psp_stats["stop_reason"] == "converged":
+                assert psp_stats["epsilon"] <= target_epsilon
+            if not psp_stats["exact"]:
+                assert psp_stats["emp_sample_complexity"] in psp_stats["schedule"]
+
+    def test_representative_pair_ids(self):
+        hand_p1 = ["H2", "S2", "C5", "D9", "C11"]
+        hand_p2 = ["H7", "S7", "C3", "D4", "D12"]
+        deck = [card for card in get_deck() if card not in hand_p1 + hand_p2]
+        some_game = create_game(
+            {
+                "deck": deck,
+                "num_discard_cards": 1,
+                "hand_p1": hand_p1,
+                "hand_p2": hand_p2,
+                "bet_grid": [1, 2],
+            }
+        )
+        # Swapping hearts and spades maps the deck onto itself, and discarding H2 onto discarding S2.
+        assert some_game.get_representative_pair_id(
+            ((1,), 1, (1,), 2)
+        ) == some_game.get_representative_pair_id(((0,), 2, (0,), 1))
+        assert some_game.get_representative_pair_id(
+            ((1,), 1, (2,), 1)
+        ) == some_game.get_representative_pair_id(((0,), 1, (2,), 1))
+        assert some_game.get_representative_pair_id(
+            ((0,), 1, (1,), 1)
+        ) != some_game.get_representative_pair_id(((0,), 1, (0,), 1))
+
+        dealer_cards = [[card] for card in deck]
+        game_stats = compute_game_stats(some_game, do_floor=False)
+        for s in some_game["strategy_profiles"]:
+            stats = compute_strategy_profile_stats(s, dealer_cards, some_game, False)
+            assert game_stats[s]["mean"] == stats["mean"]
+            assert game_stats[s]["variance"] == stats["variance"]
+
+    def test_compute_game_stats(self):
+        random.seed(0)
+        some_game = sample_game(num_discard_cards=2)
+        dealer_cards = [list(x) for x in it.combinations(some_game["deck"], 2)]
+        game_stats = compute_game_stats(some_game, do_floor=False, chunk_size=100)
+        assert game_stats.keys() == some_game["strategy_profiles"].keys()
+        for s in list(game_stats.keys())[:10]:
+            stats = compute_strategy_profile_stats(s, dealer_cards, some_game, False)
+            assert math.isclose(game_stats[s]["mean"], stats["mean"])
+            assert math.isclose(game_stats[s]["variance"], stats["variance"])
+
+    def test_shared_rank_table(self):
+        some_hands = [
+            ["S3", "C4", "D7", "C11", "D12"],
+            ["S2", "D2", "C3", "C4", "S14"],
+            ["S3", "C3", "D3", "H14", "S14"],
+        ]
+        with SharedRankTable() as shared_rank_table, ProcessPoolExecutor(
+            max_workers=1,
+            initializer=attach_shared_rank_table,
+            initargs=(shared_rank_table.handle,),
+        ) as executor:
+            for do_floor in [False, True]:
+                assert list(
+                    executor.map(get_hand_score, some_hands, [do_floor] * 3)
+                ) == [get_hand_score(hand, do_floor) for hand in some_hands]
+
+    def test_results_sink(self):
+        rows = [
+            [
+                0.01,
+                0.05,
+                1.1,
+                False,
+                f"game-{i}",
+                100,
+                2,
+                cards_to_indices(["H2", "S3", "C4", "D5", "H14"]).tolist(),
+                cards_to_indices(["S2", "D3", "H7", "C12", "D14"]).tolist(),
+                0.9,
+                60.0,
+                1000 + i,
+                90000 + i,
+                i,
+            ]
+            for i in range(5)
+        ]
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, "pair_experiment")
+            csv_path = os.path.join(tmp_dir, "pair_experiment.csv")
+            with ResultsSink(
+                path, PAIR_EXPERIMENT_SCHEMA, csv_path=csv_path, batch_size=2
+            ) as sink:
+                for row in rows:
+                    sink.append(row)
+                assert len(os.listdir(path)) == 2
+            assert len(os.listdir(path)) == 3
+
+            results = read_results(path, PAIR_EXPERIMENT_SCHEMA)
+            assert list(results.columns) == PAIR_EXPERIMENT_SCHEMA.names
+            assert list(results["game_id"]) == [f"game-{i}" for i in range(5)]
+            assert list(results["hand_p1"][0]) == rows[0][7]
+
+            csv_results = pd.read_csv(csv_path)
+            assert list(csv_results.columns) == PAIR_EXPERIMENT_SCHEMA.names
+            assert list(csv_results["emp_sample_complexity"]) == list(range(1000, 1005))
+            assert csv_results["hand_p2"][4] == "['S2', 'D3', 'H7', 'C12', 'D14']"
+
+    def test_run_manifest(self):
+        parameters = {"number_of_games": 2, "target_eps_grid": [0.1]}
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, "manifest.jsonl")
+            manifest = RunManifest(path, parameters, seed=7)
+            sink = ResultsSink(
+                os.path.join(tmp_dir, "psp_runs"),
+                PAIR_EXPERIMENT_SCHEMA,
+                batch_size=2,
+                on_flush=manifest.record,
+            )
+            row = [0.1, 0.05, 1.1, False, "game", 100, 2, [0], [1], 0.9, 60.0, 1, 2, 3]
+            sink.append(row, (0, 2, 0.1, None))
+            assert (0, 2, 0.1, None) not in manifest
+            sink.append(row, (0, 2, 0.1, 0))
+            assert (0, 2, 0.1, None) in manifest and (0, 2, 0.1, 0) in manifest
+
+            # A crash while appending leaves a partial last line, which is discarded.
+            with open(path, "a") as manifest_file:
+                manifest_file.write("[1, 2, 0.1")
+            resumed_manifest = RunManifest(path, parameters)
+            assert resumed_manifest.done == {(0, 2, 0.1, None), (0, 2, 0.1, 0)}
+            assert resumed_manifest.entropy == 7
+            resumed_manifest.record([(1, 2, 0.1, None)])
+            assert RunManifest(path, parameters).done == {
+                (0, 2, 0.1, None),
+                (0, 2, 0.1, 0),
+                (1, 2, 0.1, None),
+            }
+
+            # A crash after a batch is written, and partly appended to the CSV, but before it is recorded: recovering
+            # records its units and appends it to the CSV once.
+            def crash(keys):
+                raise KeyboardInterrupt
+
+            csv_path = os.path.join(tmp_dir, "psp_runs.csv")
+            sink_arguments = [os.path.join(tmp_dir, "psp_runs"), PAIR_EXPERIMENT_SCHEMA]
+            sink = ResultsSink(*sink_arguments, csv_path=csv_path, on_flush=crash)
+            sink.append(row, (1, 2, 0.1, 0))
+            with self.assertRaises(KeyboardInterrupt):
+                sink.flush()
+            with open(csv_path, "a") as csv_file:
+                csv_file.write("0.1,0.05")
+            resumed_manifest = RunManifest(path, parameters)
+            assert (1, 2, 0.1, 0) not in resumed_manifest
+            sink = ResultsSink(
+                *sink_arguments, csv_path=csv_path, on_flush=resumed_manifest.record
+            )
+            sink.recover(resumed_manifest)
+            assert (1, 2, 0.1, 0) in RunManifest(path, parameters)
+            assert list(pd.read_csv(csv_path)["seed"]) == [3]
+            sink.recover(resumed_manifest)
+            assert list(pd.read_csv(csv_path)["seed"]) == [3]
+
+            with self.assertRaises(ValueError):
+                RunManifest(path, {"number_of_games": 3, "target_eps_grid": [0.1]})
+            with self.assertRaises(ValueError):
+                RunManifest(path, parameters, seed=8)
+
+    def test_compare_to_baseline(self):
+        baseline = {
+            "measurements": {"psp_1_seconds": 2.0, "simulate_game_per_second": 100}
+        }
+        results = run_benchmarks(["psp"], repeat=1)
+        results["measurements"].update(
+            {"psp_1_seconds": 1.0, "simulate_game_per_second": 300}
+        )
+        assert compare_to_baseline(results, baseline) == {
+            "psp_1_seconds": 2.0,
+            "simulate_game_per_second": 3.0,
+        }